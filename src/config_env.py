@@ -1,5 +1,4 @@
 import os
-import pyproj
 import sys
 from dotenv import load_dotenv
 
@@ -12,6 +11,8 @@ def inicializar_entorno():
     os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
     # 2. Configurar PROJ (Ruta fija de tu entorno Conda)
+    # pyproj se importa aquí: cargarlo es caro y solo hace falta al inicializar
+    import pyproj
     # Nota: Si mueves el proyecto a otro PC, solo cambias esto aquí.
     ruta_proj = r"c:\Users\mosqu\.conda\envs\tfm_env\Library\share\proj"
     pyproj.datadir.set_data_dir(ruta_proj)
@@ -1,8 +1,10 @@
 # src/create_db_schema.py
 import os
+from io import StringIO
 from pathlib import Path
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from psycopg2 import sql
+from sqlalchemy import create_engine
 
 # --- CONFIGURACIÓN SEGURA ---
 
@@ -81,19 +83,56 @@ def crear_tablas():
                 PRIMARY KEY (fecha, id_estacion),
                 FOREIGN KEY (id_estacion) REFERENCES meteo_meta(id_estacion)
             );
+            """,
+            # Índices BRIN para rangos de fecha: mucho más pequeños que un B-tree en series
+            # temporales append-only (requiere cargar los datos en orden de fecha)
+            """
+            CREATE INDEX IF NOT EXISTS aforos_data_fecha_brin
+                ON aforos_data USING BRIN (fecha) WITH (pages_per_range = 32);
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS meteo_data_fecha_brin
+                ON meteo_data USING BRIN (fecha) WITH (pages_per_range = 32);
             """
         ]
 
-        with engine.connect() as conn:
+        # engine.begin() abre una única transacción y hace commit al salir:
+        # todo el DDL viaja en un solo round-trip (exec_driver_sql no parsea parámetros)
+        with engine.begin() as conn:
             print("🏗️  Construyendo esquema...")
-            for q in queries:
-                conn.execute(text(q))
-                conn.commit()
+            conn.exec_driver_sql("\n".join(queries))
             print("✅ ¡Tablas creadas exitosamente usando credenciales seguras!")
             
     except Exception as e:
         print(f"❌ Error conectando a la base de datos: {e}")
         print("Pista: Verifica que la contraseña en .env sea correcta.")
 
+def carga_masiva(engine, tabla, df, columnas):
+    """
+    Carga un DataFrame en una tabla de hechos (aforos_data, meteo_data) con COPY.
+    Es la única vía de ingesta soportada: COPY es 10-100x más rápido que INSERT fila a fila.
+    Las filas se cargan ordenadas por fecha para que el índice BRIN siga siendo selectivo.
+    """
+    if 'fecha' in columnas:
+        df = df.sort_values('fecha')
+
+    # En FORMAT csv los campos vacíos sin comillas (NaN en pandas) se cargan como NULL
+    buf = StringIO()
+    df[columnas].to_csv(buf, index=False, header=False)
+    buf.seek(0)
+
+    query = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+        sql.Identifier(tabla),
+        sql.SQL(', ').join(map(sql.Identifier, columnas))
+    )
+
+    raw = engine.raw_connection()
+    try:
+        with raw.cursor() as cur:
+            cur.copy_expert(query, buf)
+        raw.commit()
+    finally:
+        raw.close()
+
 if __name__ == "__main__":
     crear_tablas()
\ No newline at end of file
@@ -1,10 +1,16 @@
-import pandas as pd
-import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
 import glob
 import os
 import re
 import logging
+import logging.handlers
+import multiprocessing
 import json
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
@@ -21,6 +27,8 @@ logging.basicConfig(
 # --- CONFIGURACIÓN ---
 INPUT_PATH = "data/raw/c2/"
 OUTPUT_PATH = "data/interim/"
+# El CSV de inspección es lento de serializar: solo se genera con EMIT_CSV=1
+EMIT_CSV = os.getenv("EMIT_CSV") == "1"
 Path(OUTPUT_PATH).mkdir(parents=True, exist_ok=True)
 
 # Coordenadas WGS84 (Decimal Degrees)
@@ -30,6 +38,9 @@ COORDENADAS = {
     'lombos':    {'lat': 42.624998, 'lon': -8.781335, 'profundidades': ['1_5m']}
 }
 
+# Nombres de estación que se buscan en el nombre de archivo
+_STATIONS = tuple(COORDENADAS.keys())
+
 # Mapeo de códigos INTECMAR a variables
 CODIGOS_VARIABLES = {
     '2079': 'salinidad',
@@ -53,27 +64,56 @@ RANGOS_VALIDOS = {
     'salinidad_3m': (0, 40)
 }
 
+# Códigos de validación válidos (escala 0-9); el resto queda nulo antes de pasar a int8
+RANGO_QC = (0, 9)
+
+# Formatos de fecha conocidos (europeo primero); se prueban en orden con strptime de Arrow
+FORMATOS_FECHA = (
+    '%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M', '%d/%m/%Y',
+    '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y/%m/%d %H:%M'
+)
+
+# Schema Arrow de salida (idéntico para todas las estaciones, permite concat sin copias)
+ESQUEMA_SALIDA = pa.schema(
+    [('estacion', pa.string()), ('lat', pa.float64()), ('lon', pa.float64()),
+     ('fecha_hora', pa.timestamp('ms'))] +
+    # Medidas físicas con precisión ±0.01: float32 sobra y ocupa la mitad.
+    # Los códigos QC son enteros pequeños: int8
+    [(c, pa.int8() if c.startswith('qc_') else pa.float32())
+     for c in COLUMNAS_ESPERADAS if c != 'fecha_hora']
+)
 
-def extraer_profundidad(col_name):
+# Patrones compilados una sola vez (se reutilizan en cada archivo)
+_RE_PROF = re.compile(r'(\d+)[.,]?(\d*)\s*m')
+_RE_QC = re.compile(r'validaci[oó]n|c\.v\.')
+_RE_FECHA = re.compile(r'data|fecha')
+
+# Tokens semánticos de profundidad
+_TOK_SUPERFICIAL = 'superficial'
+_TOK_INFERIOR = ('inferior', 'fondo')
+
+
+@lru_cache(maxsize=None)
+def extraer_profundidad(c_lower):
     """
     Versión 3.1: Prioridad Semántica.
     Si el nombre dice 'superficial', lo estandarizamos a '1_5m' 
     (aunque ponga 1m), para unificar todas las estaciones.
+    Recibe el nombre de columna YA en minúsculas (mapear_columnas lo calcula una vez).
+    Memoizada: las cabeceras se repiten en todos los archivos de una estación.
     """
-    c_lower = col_name.lower()
-    
     # --- ESTRATEGIA 1: Búsqueda Semántica (PRIORITARIA) ---
     # Normalizamos todo lo que sea "superficie" a la etiqueta estándar '1_5m'
-    if 'superficial' in c_lower:
+    if _TOK_SUPERFICIAL in c_lower:
         return '1_5m'
     
     # Normalizamos "inferior" o "fondo" a '3m'
-    if 'inferior' in c_lower or 'fondo' in c_lower:
+    if any(tok in c_lower for tok in _TOK_INFERIOR):
         return '3m'
 
     # --- ESTRATEGIA 2: Búsqueda Numérica (FALLBACK) ---
     # Solo si no encontramos palabras clave, buscamos números explícitos.
-    match = re.search(r'(\d+)[.,]?(\d*)\s*m', c_lower)
+    match = _RE_PROF.search(c_lower)
     if match:
         entero = match.group(1)
         decimal = match.group(2) if match.group(2) else '0'
@@ -82,61 +122,117 @@ def extraer_profundidad(col_name):
     return None
 
 
-def normalizar_columnas(df):
-    new_cols = {}
-    cols_originales = list(df.columns) 
+def mapear_columnas(columnas):
+    """
+    Calcula el renombrado al esquema estándar en una sola pasada vectorizada.
+    Las columnas de QC heredan el nombre de la columna inmediatamente anterior.
+    Devuelve una lista posicional (nombre estándar o None por columna): las
+    cabeceras de QC se repiten ("Validación" tras cada variable), así que el
+    nombre original no sirve como clave.
+    """
+    import numpy as np
+    import pandas as pd
     
-    for i, col in enumerate(cols_originales):
-        c_lower = col.lower()
-        
-        # FECHA
-        if 'data' in c_lower or 'fecha' in c_lower:
-            new_cols[col] = 'fecha_hora'
-            continue
-            
-        # QC (Soporta validación y C.V.)
-        is_qc = 'validacion' in c_lower or 'validación' in c_lower or 'c.v.' in c_lower
-        
-        if is_qc:
-            if i > 0:
-                nombre_anterior_orig = cols_originales[i-1]
-                if nombre_anterior_orig in new_cols:
-                    nombre_base = new_cols[nombre_anterior_orig]
-                    new_cols[col] = f"qc_{nombre_base}"
-            continue 
-
-        # DATOS
-        profundidad = extraer_profundidad(col)
-        # FIX: Si no detecta profundidad, asumimos 1_5m (Para Lombos)
-        if not profundidad:
-            profundidad = '1_5m' 
-        
-        if 'salinidade' in c_lower or 'salinidad' in c_lower:
-            new_cols[col] = f'salinidad_{profundidad}'
-        elif 'temperatura' in c_lower:
-            new_cols[col] = f'temperatura_{profundidad}'
+    cols_originales = pd.Index(columnas)
+    lc = pd.Series(cols_originales.str.lower(), dtype=object)
 
-    return df.rename(columns=new_cols)
+    # Máscaras por tipo de columna (el orden de prioridad es FECHA > QC > DATOS)
+    es_fecha = lc.str.contains(_RE_FECHA).to_numpy()
+    es_qc = ~es_fecha & lc.str.contains(_RE_QC).to_numpy()
+    es_sal = lc.str.contains('salinidad', regex=False).to_numpy()
+    es_temp = lc.str.contains('temperatura', regex=False).to_numpy()
+
+    # DATOS
+    # FIX: Si no detecta profundidad, asumimos 1_5m (Para Lombos)
+    profundidades = pd.Series(
+        [extraer_profundidad(c_lower) or '1_5m' for c_lower in lc], dtype=object
+    )
+    nombres = np.full(len(cols_originales), None, dtype=object)
+    nombres[es_sal] = ('salinidad_' + profundidades[es_sal]).to_numpy()
+    nombres[es_temp & ~es_sal] = ('temperatura_' + profundidades[es_temp & ~es_sal]).to_numpy()
+    nombres[es_qc] = None
+    nombres[es_fecha] = 'fecha_hora'
+
+    # QC (Soporta validación y C.V.): depende del nombre ya asignado a la anterior
+    for i in np.flatnonzero(es_qc):
+        if i > 0 and nombres[i - 1] is not None:
+            nombres[i] = f"qc_{nombres[i - 1]}"
+
+    return nombres.tolist()
+
+
+def normalizar_columnas(df):
+    nombres = mapear_columnas(df.columns)
+    return df.set_axis([n or c for c, n in zip(df.columns, nombres)], axis=1)
+
+
+def parsear_fechas(columna):
+    """
+    Convierte la columna de fechas a timestamp[ms] con el strptime (C++) de Arrow.
+    Cada fila toma el primer formato de FORMATOS_FECHA que encaje; el resto queda nulo.
+    """
+    if pa.types.is_timestamp(columna.type):
+        # Arrow ya infirió el timestamp al leer (formato ISO)
+        return columna.cast(pa.timestamp('ms'))
+    
+    texto = pc.utf8_trim_whitespace(columna.cast(pa.string()))
+    candidatos = [
+        pc.strptime(texto, format=fmt, unit='ms', error_is_null=True)
+        for fmt in FORMATOS_FECHA
+    ]
+    return pc.coalesce(*candidatos)
 
 
 def validar_rangos(df, station_name):
-    """Valida que los datos estén en rangos físicamente posibles"""
-    for col, (min_val, max_val) in RANGOS_VALIDOS.items():
-        if col in df.columns:
-            mask = (df[col] < min_val) | (df[col] > max_val)
-            n_invalidos = mask.sum()
-            if n_invalidos > 0:
-                logging.warning(
-                    f"{station_name} - {col}: {n_invalidos} valores fuera de rango "
-                    f"[{min_val}, {max_val}]"
-                )
-                # Opcional: Marcar como NaN los valores inválidos
-                # df.loc[mask, col] = np.nan
+    """Valida que los datos estén en rangos físicamente posibles (una sola pasada numpy)"""
+    import numpy as np
+    
+    cols = [c for c in RANGOS_VALIDOS if c in df.columns]
+    if not cols:
+        return df
+    
+    mins = np.array([RANGOS_VALIDOS[c][0] for c in cols], dtype=np.float32)
+    maxs = np.array([RANGOS_VALIDOS[c][1] for c in cols], dtype=np.float32)
+    arr = df[cols].to_numpy(dtype=np.float32, na_value=np.nan)
+    
+    # NaN compara como False: los nulos no cuentan como fuera de rango
+    invalidos = (arr < mins) | (arr > maxs)
+    for col, n_invalidos in zip(cols, invalidos.sum(axis=0)):
+        if n_invalidos > 0:
+            min_val, max_val = RANGOS_VALIDOS[col]
+            logging.warning(
+                f"{station_name} - {col}: {n_invalidos} valores fuera de rango "
+                f"[{min_val}, {max_val}]"
+            )
+    # Opcional: Marcar como NaN los valores inválidos
+    # df[cols] = df[cols].mask(invalidos)
     return df
 
 
+def a_codigo_qc(serie, etiqueta):
+    """
+    Pasa una columna de QC a int8: los valores no enteros o fuera de RANGO_QC
+    quedan nulos (un downcast directo los truncaría o daría la vuelta).
+    """
+    import numpy as np
+    import pandas as pd
+    
+    valores = serie.to_numpy(dtype=np.float64, na_value=np.nan)
+    validos = (valores >= RANGO_QC[0]) & (valores <= RANGO_QC[1]) & (valores % 1 == 0)
+    invalidos = int((~validos & ~np.isnan(valores)).sum())
+    if invalidos:
+        logging.warning(f"{etiqueta}: {invalidos} códigos QC fuera de {RANGO_QC} convertidos a nulo")
+    codigos = pa.array(np.where(validos, valores, np.nan), from_pandas=True).cast(pa.int8())
+    return pd.Series(codigos, index=serie.index, dtype=pd.ArrowDtype(pa.int8()))
+
+
 def procesar_archivo(filepath):
-    """Procesa un archivo CSV individual detectando su formato dinámicamente"""
+    """
+    Procesa un archivo CSV individual detectando su formato dinámicamente.
+    Devuelve una pa.Table con ESQUEMA_SALIDA o None si falla.
+    """
+    import pandas as pd
+    
     try:
         filename = os.path.basename(filepath).lower()
         
@@ -146,40 +242,55 @@ def procesar_archivo(filepath):
             first_line = f.readline()
         
         # Configuración por defecto (Estilo Ribeira/Cortegada)
-        read_params = {
-            'sep': ';',
-            'decimal': ',',       # Usan coma
-            'header': 0,          # La primera línea es la cabecera
-            'encoding': 'latin-1',
-            'low_memory': False,
-            'quotechar': '"'      # Importante para limpiar las comillas del CSV
-        }
+        skip_rows = 0             # La primera línea es la cabecera
+        decimal = ','             # Usan coma
         
         # Si detectamos que es el archivo de Lombos (por el título en la línea 1)
         if "lombos" in first_line.lower() or "lombos" in filename:
             logging.info(f"   -> Detectado formato 'Lombos' en {filename}")
-            read_params['header'] = 1      # La cabecera real está en la fila 2 (índice 1)
-            read_params['decimal'] = '.'   # Lombos usa punto para decimales
+            skip_rows = 1      # La cabecera real está en la fila 2 (índice 1)
+            decimal = '.'      # Lombos usa punto para decimales
         
-        # 2. LEER CSV CON PARÁMETROS ADAPTADOS
-        df = pd.read_csv(filepath, **read_params)
+        # 2. LEER CSV CON PYARROW (multihilo, convierte decimales al parsear)
+        table = pv.read_csv(
+            filepath,
+            read_options=pv.ReadOptions(encoding='latin-1', skip_rows=skip_rows, block_size=8 << 20),
+            parse_options=pv.ParseOptions(delimiter=';', quote_char='"'),  # Limpia las comillas del CSV
+            convert_options=pv.ConvertOptions(
+                decimal_point=decimal,
+                null_values=['', 'NA', 'NaN'],
+                strings_can_be_null=True
+            )
+        )
         
         # Detectar estación para metadatos
-        station_name = None
-        for estacion in COORDENADAS.keys():
-            if estacion in filename:
-                station_name = estacion
-                break
+        station_name = next((s for s in _STATIONS if s in filename), None)
         
         if not station_name:
             logging.warning(f"Saltando {filename}: No coincide con estaciones conocidas")
             return None
 
-        # Limpiar espacios en nombres de columnas
-        df.columns = df.columns.str.strip()
+        # Limpiar espacios en nombres de columnas y normalizar sobre el schema Arrow
+        # (por posición: Arrow conserva las cabeceras duplicadas tal cual)
+        nombres = mapear_columnas([c.strip() for c in table.column_names])
+        idx_mapeadas = [i for i, n in enumerate(nombres) if n is not None]
+        table = table.select(idx_mapeadas).rename_columns([nombres[i] for i in idx_mapeadas])
         
-        # Normalizar columnas (Tu función ya arreglada)
-        df = normalizar_columnas(df)
+        # PARSEO DE FECHAS (sobre Arrow) y descarte de filas con fechas inválidas
+        len_antes = table.num_rows
+        if 'fecha_hora' in table.column_names:
+            idx = table.column_names.index('fecha_hora')
+            table = table.set_column(idx, 'fecha_hora', parsear_fechas(table['fecha_hora']))
+            table = table.filter(pc.is_valid(table['fecha_hora']))
+        else:
+            table = table.slice(0, 0)
+        
+        if table.num_rows == 0 and len_antes > 0:
+            logging.warning(f"⚠️ {filename}: Se perdieron TODAS las filas al parsear fechas. Revisa el formato.")
+        elif table.num_rows < len_antes:
+            logging.warning(f"{filename}: {len_antes - table.num_rows} filas con fecha inválida descartadas")
+        
+        df = table.to_pandas(types_mapper=pd.ArrowDtype)
         
         # Asegurar que TODAS las columnas esperadas existen
         for col in COLUMNAS_ESPERADAS:
@@ -189,29 +300,22 @@ def procesar_archivo(filepath):
         # Seleccionar solo columnas de interés
         df = df[COLUMNAS_ESPERADAS]
 
-        # 3. LIMPIEZA DE DATOS NUMÉRICOS (DOBLE CHECK)
-        # Aunque hayamos seteado el decimal, a veces quedan strings sucios.
+        # 3. TIPOS NUMÉRICOS
+        # Arrow ya convirtió el decimal al parsear; solo queda texto si había valores sucios.
         cols_numericas = [c for c in df.columns if 'salinidad' in c or 'temperatura' in c]
+        cols_texto = df[cols_numericas].select_dtypes(exclude='number').columns
+        if len(cols_texto):
+            df[cols_texto] = df[cols_texto].apply(
+                lambda s: pd.to_numeric(s.astype(str).str.replace(',', '.', regex=False), errors='coerce')
+            )
+        # Tipo común para que el concat entre estaciones no degrade a object:
+        # float32 para las medidas, int8 para los códigos QC
+        cols_medidas = [c for c in cols_numericas if not c.startswith('qc_')]
+        df[cols_medidas] = df[cols_medidas].astype(pd.ArrowDtype(pa.float32()))
         for col in cols_numericas:
-            if df[col].dtype == 'object':
-                # Si sigue siendo texto, forzamos reemplazo de coma por punto por si acaso
-                df[col] = df[col].astype(str).str.replace(',', '.')
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-        
-        # 4. PARSEO DE FECHAS (FLEXIBLE)
-        # Sin formato fijo, con dayfirst=True para formato europeo
-        df['fecha_hora'] = pd.to_datetime(
-            df['fecha_hora'], 
-            dayfirst=True, 
-            errors='coerce'
-        )
+            if col.startswith('qc_'):
+                df[col] = a_codigo_qc(df[col], f"{station_name} - {col}")
         
-        # Eliminar filas con fechas inválidas
-        len_antes = len(df)
-        df = df.dropna(subset=['fecha_hora'])
-        if len(df) == 0 and len_antes > 0:
-            logging.warning(f"⚠️ {filename}: Se perdieron TODAS las filas al parsear fechas. Revisa el formato.")
-
         # Validar rangos
         df = validar_rangos(df, station_name)
         
@@ -226,13 +330,46 @@ def procesar_archivo(filepath):
         df = df[cols_ordenadas]
         
         logging.info(f"[OK] Procesado {filename}: {len(df)} filas")
-        return df
+        return pa.Table.from_pandas(df, preserve_index=False).cast(ESQUEMA_SALIDA)
 
     except Exception as e:
         logging.error(f"Error procesando {filepath}: {e}", exc_info=True)
         return None
 
 
+def deduplicar_ordenado(master):
+    """
+    Ordena por estación y fecha y elimina duplicados en la misma pasada
+    (equivale a DISTINCT ON (estacion, fecha_hora) ... ORDER BY, con keep='last').
+    """
+    import numpy as np
+    
+    master = master.append_column('_fila', pa.array(np.arange(master.num_rows)))
+    master = master.sort_by([('estacion', 'ascending'), ('fecha_hora', 'ascending'), ('_fila', 'ascending')])
+    
+    n = master.num_rows
+    if n > 1:
+        # Tras ordenar, la última aparición de cada clave es la fila cuya siguiente cambia de clave
+        estacion, fecha = master['estacion'], master['fecha_hora']
+        cambia = pc.or_(
+            pc.not_equal(estacion.slice(0, n - 1), estacion.slice(1)),
+            pc.not_equal(fecha.slice(0, n - 1), fecha.slice(1))
+        )
+        master = master.filter(pa.chunked_array(cambia.chunks + [pa.array([True])]))
+    
+    return master.drop_columns(['_fila'])
+
+
+def _init_worker(log_queue):
+    """Redirige el logging del proceso hijo a la cola que escribe el proceso principal"""
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+
+
 def generar_reporte_calidad(df):
     """Genera estadísticas de calidad del dataset unificado"""
     reporte = {
@@ -259,6 +396,10 @@ def generar_reporte_calidad(df):
 
 # --- EJECUCIÓN PRINCIPAL ---
 def main():
+    # pandas se importa aquí para que importar el módulo sea barato
+    import pandas as pd
+    from formato_csv import a_float64_csv
+    
     logging.info("="*60)
     logging.info("INICIO DEL PROCESAMIENTO DE DATOS INTECMAR")
     logging.info("="*60)
@@ -271,43 +412,52 @@ def main():
         logging.error(f"No se encontraron archivos en {INPUT_PATH}")
         return
     
-    # Procesar archivos
-    dfs = []
-    for filepath in all_files:
-        df_temp = procesar_archivo(filepath)
-        if df_temp is not None:
-            dfs.append(df_temp)
+    # Procesar archivos en paralelo (cada archivo es independiente)
+    # Los logs de los workers pasan por una cola para que solo escriba este proceso
+    log_queue = multiprocessing.Queue(-1)
+    listener = logging.handlers.QueueListener(
+        log_queue, *logging.getLogger().handlers, respect_handler_level=True
+    )
+    listener.start()
+    try:
+        n_workers = min(len(all_files), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(log_queue,)) as ex:
+            tablas = [t for t in ex.map(procesar_archivo, all_files, chunksize=1) if t is not None]
+    finally:
+        listener.stop()
     
-    if not dfs:
+    if not tablas:
         logging.error("No se pudo procesar ningún archivo válido")
         return
     
-    # Unificar
-    logging.info("Unificando DataFrames...")
-    master_df = pd.concat(dfs, ignore_index=True)
+    # Unificar (Arrow concatena los buffers sin copiar)
+    logging.info("Unificando tablas Arrow...")
+    master = pa.concat_tables(tablas)
+    del tablas
     
-    # Eliminar duplicados temporales
-    duplicados_antes = len(master_df)
-    master_df = master_df.drop_duplicates(
-        subset=['estacion', 'fecha_hora'], 
-        keep='last'
-    )
-    duplicados_eliminados = duplicados_antes - len(master_df)
+    # Ordenar cronológicamente y eliminar duplicados temporales en una sola pasada
+    duplicados_antes = master.num_rows
+    master = deduplicar_ordenado(master)
+    duplicados_eliminados = duplicados_antes - master.num_rows
     if duplicados_eliminados > 0:
         logging.warning(f"Eliminados {duplicados_eliminados} registros duplicados")
     
-    # Ordenar cronológicamente
-    master_df = master_df.sort_values(by=['estacion', 'fecha_hora']).reset_index(drop=True)
-    
     # Guardar archivos
     output_parquet = os.path.join(OUTPUT_PATH, "intecmar_master_unificado.parquet")
     output_csv = os.path.join(OUTPUT_PATH, "intecmar_master_unificado.csv")
     
-    master_df.to_parquet(output_parquet, index=False)
-    master_df.to_csv(output_csv, index=False, sep=';', decimal=',')
+    with pq.ParquetWriter(output_parquet, master.schema, compression='zstd', compression_level=3) as writer:
+        writer.write_table(master)
     
     logging.info(f"OK Datos guardados en: {output_parquet}")
-    logging.info(f"OK CSV de inspección en: {output_csv}")
+    
+    master_df = master.to_pandas(types_mapper=pd.ArrowDtype)
+    if EMIT_CSV:
+        # pandas en vez de pyarrow.csv: Arrow no sabe escribir decimal con coma
+        # float32 -> float64 (mismo helper que el CTD) para no escribir 35,099998474121094
+        a_float64_csv(master_df).to_csv(output_csv, index=False, sep=';', decimal=',')
+        logging.info(f"OK CSV de inspección en: {output_csv}")
     
     # Generar reporte
     reporte = generar_reporte_calidad(master_df)
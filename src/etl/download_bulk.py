@@ -1,17 +1,26 @@
 
 import os
+import io
+import re
+import json
 import logging
+import xml.etree.ElementTree as ET
 from pathlib import Path
 from datetime import date, timedelta
 from dataclasses import dataclass
-from typing import Generator, Optional
+from typing import Generator, Optional, Set
 import time
 import signal
 import sys
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import h5py
 import xarray as xr
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 # ============================================================================
 # CONFIGURACIÓN
@@ -27,8 +36,15 @@ class Config:
     MAX_RETRIES: int = int(os.getenv("MAX_RETRIES", "3"))
     RETRY_BASE_DELAY: float = 2.0  # Segundos (con backoff exponencial)
     TIMEOUT_SECONDS: int = 60
-    REQUEST_DELAY: float = 0.5  # Pausa entre descargas (Bajado a 0.5 para ir un poco más rápido)
+    REQUEST_DELAY: float = 0.5  # Intervalo mínimo entre peticiones al servidor (cortesía)
+    # Descarga directa por HTTP (fileServer) en vez de OPeNDAP: más rápida pero baja el archivo entero
+    DIRECT_HTTP: bool = os.getenv("DIRECT_HTTP") == "1"
+    # Descargas simultáneas. Solo compensan con DIRECT_HTTP=1: por OPeNDAP xarray lee con el
+    # backend netCDF4 bajo un lock global (NETCDF4_PYTHON_LOCK) y las transferencias van de una
+    # en una aunque haya varios hilos, así que por defecto se usa un único hilo
+    MAX_WORKERS: int = int(os.getenv("MAX_WORKERS", "8" if DIRECT_HTTP else "1"))
     MIN_FILE_SIZE: int = 1000  # Bytes mínimos para considerar válido
+    MANIFEST_FILE: str = "_manifest.json"  # Caché de archivos ya validados (tamaño + mtime)
     
     def __post_init__(self):
         """Validaciones post-inicialización"""
@@ -39,6 +55,26 @@ class Config:
         
         if self.MAX_RETRIES < 1:
             raise ValueError("MAX_RETRIES debe ser al menos 1")
+        
+        if self.MAX_WORKERS < 1:
+            raise ValueError("MAX_WORKERS debe ser al menos 1")
+
+# Guardar con compresión (4 es un buen balance velocidad/compresión)
+PREC_ENCODING = {
+    'prec': {
+        'zlib': True,
+        'complevel': 4,
+        'dtype': 'float32'
+    }
+}
+
+# Carpetas diarias del catálogo THREDDS (YYYYMMDD)
+CATALOG_DATE_PATTERN = re.compile(r'(?<!\d)(\d{8})(?!\d)')
+
+# Sesión HTTP compartida: reutiliza conexiones keep-alive con el servidor THREDDS
+# (Session es segura para get/head concurrentes desde el pool de descargas)
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=16))
 
 # ============================================================================
 # LOGGING
@@ -72,11 +108,30 @@ def setup_logging(log_file: str = "descarga_wrf.log") -> logging.Logger:
         '%(levelname)s: %(message)s'
     ))
     
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    # Los hilos de descarga solo encolan; un hilo de fondo escribe a disco/consola
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    logger.addHandler(QueueHandler(log_queue))
+    listener.start()
+    
+    # Guardamos el listener para vaciar la cola con shutdown_logging() al terminar
+    logger.listener = listener
     
     return logger
 
+def shutdown_logging(logger: logging.Logger):
+    """Vacía la cola de logs y retira los handlers (idempotente; setup_logging los recrea)."""
+    listener = getattr(logger, 'listener', None)
+    if listener is None:
+        return
+    
+    listener.stop()  # Escribe lo que quede en la cola antes de parar el hilo
+    for handler in listener.handlers:
+        handler.close()
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+    logger.listener = None
+
 # ============================================================================
 # UTILIDADES
 # ============================================================================
@@ -90,13 +145,13 @@ def date_range(start: date, end: date) -> Generator[date, None, None]:
 def validate_netcdf_file(filepath: Path, logger: logging.Logger) -> bool:
     """Valida que un archivo NetCDF sea legible y contenga la variable 'prec'."""
     try:
-        # Abrimos sin decodificar tiempos para ser rápidos en la validación
-        with xr.open_dataset(filepath, decode_times=False, engine='netcdf4') as ds:
-            if 'prec' not in ds:
+        # NetCDF4 es HDF5: basta leer la cabecera del dataset, sin construir el árbol de xarray
+        with h5py.File(filepath, 'r') as f:
+            if 'prec' not in f:
                 logger.warning(f" {filepath.name}: falta variable 'prec'")
                 return False
             
-            if ds['prec'].size == 0:
+            if f['prec'].size == 0:
                 logger.warning(f" {filepath.name}: variable 'prec' vacía")
                 return False
             
@@ -106,13 +161,68 @@ def validate_netcdf_file(filepath: Path, logger: logging.Logger) -> bool:
         logger.warning(f" {filepath.name}: corrupto o ilegible ({type(e).__name__})")
         return False
 
+def load_manifest(path: Path, logger: logging.Logger) -> dict:
+    """Carga el manifiesto {nombre: {size, mtime_ns}} de archivos ya validados."""
+    if not path.exists():
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f" Manifiesto ilegible ({type(e).__name__}), se revalidará todo")
+        return {}
+
+def save_manifest(manifest: dict, path: Path, logger: logging.Logger):
+    """Escribe el manifiesto de forma atómica (tmp + replace)."""
+    tmp_path = path.with_suffix('.tmp')
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f" No se pudo guardar el manifiesto: {e}")
+
+def file_signature(filepath: Path) -> dict:
+    st = filepath.stat()
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+def fetch_available_dates(base_url: str, timeout: int, logger: logging.Logger) -> Optional[Set[str]]:
+    """
+    Lee una sola vez el catálogo THREDDS y devuelve las fechas (YYYYMMDD) publicadas.
+    Devuelve None si el catálogo no está disponible (se usará HEAD por fecha).
+    """
+    catalog_url = f"{base_url.replace('dodsC', 'catalog')}/catalog.xml"
+    
+    try:
+        response = SESSION.get(catalog_url, timeout=timeout)
+        response.raise_for_status()
+        
+        available = set()
+        for _, elem in ET.iterparse(io.BytesIO(response.content)):
+            if elem.tag.endswith(('dataset', 'catalogRef')):
+                for value in elem.attrib.values():
+                    match = CATALOG_DATE_PATTERN.search(value)
+                    if match:
+                        available.add(match.group(1))
+            elem.clear()
+        
+        if not available:
+            logger.warning(f" Catálogo sin fechas reconocibles: {catalog_url}")
+            return None
+        
+        return available
+        
+    except (requests.RequestException, ET.ParseError) as e:
+        logger.warning(f" Catálogo no disponible ({type(e).__name__}), se verificará fecha a fecha")
+        return None
+
 def check_remote_file_exists(url: str, timeout: int, logger: logging.Logger) -> Optional[bool]:
     """Verifica si un archivo remoto existe sin descargarlo completamente."""
     # Truco: Cambiamos dodsC (OPeNDAP) por fileServer (HTTP directo) para hacer HEAD request
     check_url = url.replace("dodsC", "fileServer")
     
     try:
-        response = requests.head(
+        response = SESSION.head(
             check_url,
             timeout=timeout,
             allow_redirects=True
@@ -152,18 +262,8 @@ def download_precipitation_data(url: str, filepath: Path, timeout: int, logger:
                 logger.error(f" Variable 'prec' no encontrada en {url}")
                 return False
             
-            da_prec = ds['prec']
-            
-            # Guardar con compresión
-            encoding = {
-                'prec': {
-                    'zlib': True,
-                    'complevel': 4, # 4 es un buen balance velocidad/compresión
-                    'dtype': 'float32'
-                }
-            }
-            
-            da_prec.to_netcdf(filepath, encoding=encoding)
+            da_prec = ds['prec'].astype('float32')
+            da_prec.to_netcdf(filepath, encoding=PREC_ENCODING)
             
             file_size_kb = filepath.stat().st_size / 1024
             logger.info(f" Descargado: {filepath.name} ({file_size_kb:.1f} KB)")
@@ -179,6 +279,43 @@ def download_precipitation_data(url: str, filepath: Path, timeout: int, logger:
         
         return False
 
+def download_precipitation_http(url: str, filepath: Path, timeout: int, logger: logging.Logger) -> bool:
+    """Descarga el .nc4 completo por HTTP (fileServer) y extrae 'prec' en local."""
+    download_url = url.replace("dodsC", "fileServer")
+    tmp_path = filepath.with_suffix('.nc4.tmp')
+    
+    try:
+        with SESSION.get(download_url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
+        
+        with xr.open_dataset(tmp_path, decode_times=False, engine='h5netcdf') as ds:
+            if 'prec' not in ds:
+                logger.error(f" Variable 'prec' no encontrada en {download_url}")
+                return False
+            
+            ds[['prec']].astype('float32').to_netcdf(filepath, encoding=PREC_ENCODING)
+        
+        file_size_kb = filepath.stat().st_size / 1024
+        logger.info(f" Descargado (HTTP): {filepath.name} ({file_size_kb:.1f} KB)")
+        return True
+        
+    except Exception as e:
+        logger.error(f" Error descargando desde {download_url}: {type(e).__name__}: {e}")
+        
+        # Limpiar archivo parcial si existe
+        if filepath.exists():
+            filepath.unlink()
+            logger.debug(f" Eliminado archivo parcial: {filepath.name}")
+        
+        return False
+    
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
 def exponential_backoff_retry(func, max_retries: int, base_delay: float, logger: logging.Logger, *args, **kwargs):
     """Ejecuta una función con reintentos y backoff exponencial."""
     last_exception = None
@@ -208,6 +345,64 @@ def exponential_backoff_retry(func, max_retries: int, base_delay: float, logger:
             
     raise last_exception
 
+class RateLimiter:
+    """Espacia el inicio de las peticiones sin serializar las descargas en curso."""
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+    
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.min_interval
+        if delay > 0:
+            time.sleep(delay)
+
+def process_date(date_str: str, url: str, filepath: Path, config: Config,
+                 limiter: RateLimiter, logger: logging.Logger, in_catalog: bool = False) -> str:
+    """Verifica y descarga una fecha. Devuelve la clave de `stats` a incrementar."""
+    if in_catalog:
+        # La carpeta del día figura en el catálogo: se intenta la descarga sin HEAD previo
+        exists = True
+    else:
+        limiter.wait()
+        exists = check_remote_file_exists(url, config.TIMEOUT_SECONDS, logger)
+    
+    if exists is False:
+        logger.debug(f" {date_str}: 404 No encontrado")
+        return 'no_disponibles'
+    
+    if exists is None:
+        logger.warning(f" {date_str}: Error de conexión al verificar")
+        return 'errores'
+    
+    try:
+        limiter.wait()
+        download_func = download_precipitation_http if config.DIRECT_HTTP else download_precipitation_data
+        success = exponential_backoff_retry(
+            download_func,
+            config.MAX_RETRIES,
+            config.RETRY_BASE_DELAY,
+            logger,
+            url,
+            filepath,
+            config.TIMEOUT_SECONDS,
+            logger
+        )
+        if not success and in_catalog:
+            # El catálogo lista carpetas, no archivos: si falla, HEAD para distinguir un 404
+            limiter.wait()
+            if check_remote_file_exists(url, config.TIMEOUT_SECONDS, logger) is False:
+                logger.debug(f" {date_str}: en el catálogo pero sin archivo (404)")
+                return 'no_disponibles'
+        return 'descargados' if success else 'errores'
+        
+    except Exception as e:
+        logger.error(f" {date_str}: Fallo crítico")
+        return 'errores'
+
 # ============================================================================
 # MANEJO DE SEÑALES
 # ============================================================================
@@ -228,47 +423,66 @@ class GracefulKiller:
 def main():
     config = Config()
     logger = setup_logging()
-    killer = GracefulKiller(logger)
+    try:
+        killer = GracefulKiller(logger)
     
-    logger.info("=" * 80)
-    logger.info(f" INICIANDO DESCARGA MASIVA WRF (MODO PRO)")
-    logger.info(f" Período: {config.START_DATE} hasta {config.END_DATE}")
-    logger.info(f" Destino: {config.OUTPUT_DIR.absolute()}")
-    logger.info("=" * 80)
+        logger.info("=" * 80)
+        logger.info(f" INICIANDO DESCARGA MASIVA WRF (MODO PRO)")
+        logger.info(f" Período: {config.START_DATE} hasta {config.END_DATE}")
+        logger.info(f" Destino: {config.OUTPUT_DIR.absolute()}")
+        logger.info(f" Modo: {'HTTP directo (fileServer)' if config.DIRECT_HTTP else 'OPeNDAP'}")
+        logger.info(f" Hilos de descarga: {config.MAX_WORKERS}")
+        if not config.DIRECT_HTTP and config.MAX_WORKERS > 1:
+            logger.info(" Aviso: en modo OPeNDAP las lecturas de netCDF4 se serializan; "
+                        "el paralelismo solo solapa las comprobaciones HEAD")
+        logger.info("=" * 80)
     
-    all_dates = list(date_range(config.START_DATE, config.END_DATE))
+        all_dates = list(date_range(config.START_DATE, config.END_DATE))
     
-    stats = {
-        'existentes': 0,
-        'descargados': 0,
-        'no_disponibles': 0,
-        'errores': 0,
-        'corruptos_reparados': 0
-    }
+        stats = {
+            'existentes': 0,
+            'descargados': 0,
+            'no_disponibles': 0,
+            'errores': 0,
+            'corruptos_reparados': 0
+        }
     
-    # Barra de progreso
-    with tqdm(all_dates, unit="día", desc="Progreso Global") as pbar:
-        for current_date in pbar:
-            
+        # Los archivos sin cambios desde la última validación no se vuelven a abrir
+        manifest_path = config.OUTPUT_DIR / config.MANIFEST_FILE
+        manifest = load_manifest(manifest_path, logger)
+    
+        # Un único listado del servidor evita un HEAD por cada fecha inexistente
+        available = fetch_available_dates(config.BASE_URL, config.TIMEOUT_SECONDS, logger)
+        if available is not None:
+            logger.info(f" Catálogo THREDDS: {len(available)} fechas publicadas")
+    
+        # 1. Pasada local (rápida, en serie): descartar fechas ya descargadas y válidas
+        tasks = []
+        for current_date in all_dates:
             if killer.kill_now:
                 logger.warning(" Proceso interrumpido por usuario")
+                tasks = []
                 break
-            
+        
             date_str = current_date.strftime("%Y%m%d")
             year = current_date.strftime("%Y")
-            
+        
             save_folder = config.OUTPUT_DIR / year
             save_folder.mkdir(exist_ok=True)
-            
+        
             filename = f"WRF_1km_prec_{date_str}.nc"
             filepath = save_folder / filename
-            
-            pbar.set_postfix_str(f"{date_str}")
-            
-            # 1. Verificar si ya existe y es válido
+        
             if filepath.exists():
-                if filepath.stat().st_size > config.MIN_FILE_SIZE:
+                signature = file_signature(filepath)
+                if manifest.get(filename) == signature:
+                    stats['existentes'] += 1
+                    logger.debug(f" Saltando {date_str} (validado previamente)")
+                    continue
+            
+                if signature['size'] > config.MIN_FILE_SIZE:
                     if validate_netcdf_file(filepath, logger):
+                        manifest[filename] = signature
                         stats['existentes'] += 1
                         logger.debug(f" Saltando {date_str} (ya existe y es válido)")
                         continue
@@ -279,56 +493,60 @@ def main():
                 else:
                     logger.warning(f" Archivo incompleto: {filename}")
                     filepath.unlink()
-            
-            # 2. Construir URL y verificar servidor
-            url = f"{config.BASE_URL}/{date_str}/wrf_arw_det_history_d02_{date_str}_0000.nc4"
-            exists = check_remote_file_exists(url, config.TIMEOUT_SECONDS, logger)
-            
-            if exists is False:
-                logger.debug(f" {date_str}: 404 No encontrado")
+                manifest.pop(filename, None)
+        
+            if available is not None and date_str not in available:
+                logger.debug(f" {date_str}: no figura en el catálogo")
                 stats['no_disponibles'] += 1
                 continue
-            
-            if exists is None:
-                logger.warning(f" {date_str}: Error de conexión al verificar")
-                stats['errores'] += 1
-                continue
-            
-            # 3. Descargar
-            try:
-                success = exponential_backoff_retry(
-                    download_precipitation_data,
-                    config.MAX_RETRIES,
-                    config.RETRY_BASE_DELAY,
-                    logger,
-                    url,
-                    filepath,
-                    config.TIMEOUT_SECONDS,
-                    logger
-                )
-                if success:
-                    stats['descargados'] += 1
-                else:
-                    stats['errores'] += 1
-                    
-            except Exception as e:
-                logger.error(f" {date_str}: Fallo crítico")
-                stats['errores'] += 1
-            
-            # Pausa breve
-            time.sleep(config.REQUEST_DELAY)
+        
+            url = f"{config.BASE_URL}/{date_str}/wrf_arw_det_history_d02_{date_str}_0000.nc4"
+            tasks.append((date_str, url, filepath))
+    
+        # 2. Descargas concurrentes (limitadas por red, no por CPU)
+        limiter = RateLimiter(config.REQUEST_DELAY)
+        with ThreadPoolExecutor(max_workers=config.MAX_WORKERS) as executor:
+            futures = {
+                executor.submit(process_date, date_str, url, filepath, config, limiter, logger,
+                                available is not None): (date_str, filepath)
+                for date_str, url, filepath in tasks
+            }
+        
+            with tqdm(total=len(futures), unit="día", desc="Progreso Global") as pbar:
+                for future in as_completed(futures):
+                    date_str, filepath = futures[future]
+                    result = future.result()
+                    stats[result] += 1
+                    if result == 'descargados':
+                        manifest[filepath.name] = file_signature(filepath)
+                    pbar.set_postfix_str(date_str)
+                    pbar.update(1)
+                
+                    if killer.kill_now:
+                        logger.warning(" Proceso interrumpido por usuario")
+                        for pending in futures:
+                            pending.cancel()
+                        break
 
-    # Resumen
-    print("\n" + "=" * 60)
-    print(" RESUMEN FINAL")
-    print(f" Válidos previos:    {stats['existentes']}")
-    print(f" Descargados hoy:    {stats['descargados']}")
-    print(f" Corruptos reparados:{stats['corruptos_reparados']}")
-    print(f" No disponibles:     {stats['no_disponibles']}")
-    print(f" Errores:            {stats['errores']}")
-    print("=" * 60)
+        save_manifest(manifest, manifest_path, logger)
+    
+        # Vaciar la cola de logs antes de imprimir el resumen
+        shutdown_logging(logger)
+    
+        # Resumen
+        print("\n" + "=" * 60)
+        print(" RESUMEN FINAL")
+        print(f" Válidos previos:    {stats['existentes']}")
+        print(f" Descargados hoy:    {stats['descargados']}")
+        print(f" Corruptos reparados:{stats['corruptos_reparados']}")
+        print(f" No disponibles:     {stats['no_disponibles']}")
+        print(f" Errores:            {stats['errores']}")
+        print("=" * 60)
     
-    return 0
+        return 0
+    finally:
+        # También tras una excepción o Ctrl+C: los registros encolados no se pierden
+        shutdown_logging(logger)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,19 @@
+import numpy as np
+import pandas as pd
+
+# Columnas float32 en NumPy o en Arrow (types_mapper=pd.ArrowDtype)
+_DTYPES_FLOAT32 = ('float32', 'float[pyarrow]')
+
+
+def a_float64_csv(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Copia para CSV con las columnas float32 en float64 por su representación corta,
+    para no escribir artefactos de precisión (35.1 y no 35.099998).
+    Común a los CSV de inspección de INTECMAR y CTD: el mismo dato se escribe igual.
+    """
+    out = df.copy()
+    for col, dtype in df.dtypes.items():
+        if str(dtype) in _DTYPES_FLOAT32:
+            valores = df[col].to_numpy(dtype=np.float32, na_value=np.nan)
+            out[col] = valores.astype(str).astype(np.float64)
+    return out
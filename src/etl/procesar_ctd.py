@@ -1,23 +1,34 @@
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
 import glob
 import logging
+import logging.handlers
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from typing import Optional, Dict, List
 import json
+import mmap
+from functools import lru_cache
 from dataclasses import dataclass
 from datetime import datetime
 
+from formato_csv import a_float64_csv
+
 # --- CONFIGURACIÓN ---
 @dataclass
 class Config:
     """Configuración centralizada del proyecto"""
     INPUT_PATH: Path = Path("data/raw/c1/")
     OUTPUT_PATH: Path = Path("data/interim/")
-    OUTPUT_FILE: str = "ctd_arousa_historico_unificado.csv"
+    OUTPUT_FILE: str = "ctd_arousa_historico_unificado.parquet"
+    EMIT_CSV: bool = os.getenv("EMIT_CSV") == "1"  # Copia CSV (;) para inspección manual
     COORDS_FILE: Path = Path("config/coordenadas_ctd.json")
     LOG_PATH: Path = Path("logs/")
+    HEADER_CACHE_FILE: Path = Path("logs/header_cache.json")
     
     # Parámetros de calidad
     MAX_PROFUNDIDAD: float = 500.0  # metros
@@ -29,9 +40,131 @@ class Config:
 # Instancia global de configuración
 config = Config()
 
+# Tipos de las columnas raw conocidas: el parser C no tiene que inferirlos
+DTYPES_RAW = {
+    'Código': 'string',
+    'Estacion': 'string',
+    'Data': 'string',
+    **{f'VAR_{i}': 'float32' for i in range(13)},
+    # QC como float: con Int8 el parser C da la vuelta a los valores fuera de rango
+    # (-999 -> 25) sin avisar; se validan y reducen a Int8 después (a_codigo_qc)
+    **{f'CODVAL_{i}': 'float32' for i in range(13)},
+}
+
+# Formatos de fecha conocidos (día primero, como exporta INTECMAR)
+FORMATOS_FECHA = (
+    '%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M', '%d/%m/%Y',
+    '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M'
+)
+
+def detectar_formato_fecha(muestra: str) -> Optional[str]:
+    """Devuelve el primer formato de FORMATOS_FECHA que parsea la muestra, o None"""
+    for fmt in FORMATOS_FECHA:
+        try:
+            datetime.strptime(muestra.strip(), fmt)
+            return fmt
+        except ValueError:
+            continue
+    return None
+
+# Nombres raw INTECMAR -> nombres estandarizados (constante: se construye una vez)
+RENAME_MAP = {
+    # Identificadores
+    'Código': 'estacion_id',
+    'Estacion': 'estacion_nombre',
+    'Data': 'fecha_hora',
+
+    # Variables Físico-Químicas
+    'VAR_0': 'temperatura',
+    'VAR_1': 'salinidad',
+    'VAR_2': 'presion_db',        # Decibares
+    'VAR_3': 'ph',
+    'VAR_4': 'oxigeno_ml_l',      # ml/l
+    'VAR_5': 'transmitancia',
+    'VAR_6': 'irradiancia',
+    'VAR_7': 'fluorescencia_uv',
+    'VAR_8': 'fluorescencia',     # Clorofila
+    'VAR_9': 'densidad',          # Sigma-T
+    'VAR_10': 'profundidad',
+    'VAR_11': 'temperatura_its68',
+    'VAR_12': 'conductividad',
+
+    # Control de Calidad (QC) - Mapeamos los más críticos
+    'CODVAL_0': 'qc_temperatura',
+    'CODVAL_1': 'qc_salinidad',
+    'CODVAL_4': 'qc_oxigeno',
+    'CODVAL_8': 'qc_fluorescencia'
+}
+RENAME_VALUES = frozenset(RENAME_MAP.values())
+
+# Orden de salida: columnas clave primero, resto de variables, metadatos al final
+COLS_CLAVE = ('estacion_id', 'estacion_nombre', 'lat', 'lon', 'fecha_hora', 'profundidad',
+              'salinidad', 'qc_salinidad', 'temperatura', 'qc_temperatura')
+COLS_META = ('origen_archivo',)
+
+# float32 sobra para los rangos CTD (error relativo < 1e-6) y los códigos QC caben en Int8
+COLS_FLOAT32 = ('temperatura', 'salinidad', 'presion_db', 'ph', 'oxigeno_ml_l', 'transmitancia',
+                'irradiancia', 'fluorescencia_uv', 'fluorescencia', 'densidad', 'profundidad',
+                'temperatura_its68', 'conductividad')
+COLS_QC = ('qc_temperatura', 'qc_salinidad', 'qc_oxigeno', 'qc_fluorescencia')
+RANGO_QC = (0, 9)  # Códigos de validación válidos (escala 0-9); el resto queda nulo
+# Texto de baja cardinalidad (≤11 estaciones, ≤N archivos): category
+COLS_CATEGORIA = ('estacion_id', 'estacion_nombre', 'origen_archivo')
+
+# Esquema fijo de salida: cada archivo se escribe según termina, así que todos
+# deben compartir columnas (las que falten en un archivo quedan nulas)
+_CATEGORIA = pa.dictionary(pa.int32(), pa.string())
+ESQUEMA_SALIDA = pa.schema(
+    [('estacion_id', _CATEGORIA), ('estacion_nombre', _CATEGORIA),
+     ('lat', pa.float64()), ('lon', pa.float64()), ('fecha_hora', pa.timestamp('us')),
+     ('profundidad', pa.float32()), ('salinidad', pa.float32()), ('qc_salinidad', pa.int8()),
+     ('temperatura', pa.float32()), ('qc_temperatura', pa.int8())] +
+    [(c, pa.float32()) for c in COLS_FLOAT32
+     if c not in ('profundidad', 'salinidad', 'temperatura')] +
+    [('qc_oxigeno', pa.int8()), ('qc_fluorescencia', pa.int8()),
+     ('origen_archivo', _CATEGORIA)]
+)
+
+def a_codigo_qc(serie: pd.Series) -> pd.Series:
+    """
+    Reduce una columna de QC a Int8 sin corromperla: los valores no numéricos,
+    no enteros (1,5) o fuera de RANGO_QC (-999) pasan a nulo antes del downcast.
+    """
+    valores = pd.to_numeric(serie, errors='coerce').astype('float64')
+    validos = valores.between(*RANGO_QC) & (valores % 1 == 0)
+    return valores.where(validos).astype('Int8')
+
+def a_tabla_salida(df: pd.DataFrame) -> pa.Table:
+    """Convierte un DataFrame procesado a Arrow con el esquema de salida"""
+    tabla = pa.Table.from_pandas(df, preserve_index=False)
+    columnas = [
+        tabla.column(campo.name).cast(campo.type) if campo.name in tabla.column_names
+        else pa.nulls(tabla.num_rows, campo.type)
+        for campo in ESQUEMA_SALIDA
+    ]
+    return pa.Table.from_arrays(columnas, schema=ESQUEMA_SALIDA)
+
+def ordenar_salida_global(outfile: Path, csv_file: Path, esquema: pa.Schema):
+    """
+    Reescribe la salida ordenada por fecha y estación en todo el histórico.
+    Solo hace falta si los archivos se solapan en el tiempo (carga todo en memoria).
+    """
+    df = pq.read_table(outfile).to_pandas(types_mapper={pa.int8(): pd.Int8Dtype()}.get)
+    # Estación como texto: las categorías leídas del Parquet no tienen por qué ir en orden alfabético
+    df = df.sort_values(by=['fecha_hora', 'estacion_id'], kind='stable',
+                        key=lambda s: s.astype('string') if s.name == 'estacion_id' else s)
+    with pq.ParquetWriter(outfile, esquema, compression='snappy') as writer:
+        writer.write_table(a_tabla_salida(df))
+    if config.EMIT_CSV:
+        a_float64_csv(df).to_csv(csv_file, index=False, sep=';', decimal='.', encoding='utf-8')
+
 # --- CONFIGURACIÓN DE LOGGING AVANZADA ---
+@lru_cache(maxsize=1)
 def setup_logging():
-    """Configura sistema de logging con rotación de archivos"""
+    """
+    Configura sistema de logging con rotación de archivos.
+    Se llama desde main() (una sola vez): importar el módulo no crea archivos de log.
+    """
     config.LOG_PATH.mkdir(parents=True, exist_ok=True)
     
     # Formato detallado
@@ -62,12 +195,14 @@ def setup_logging():
     
     return logger
 
-logger = setup_logging()
+# Los handlers los añade setup_logging(); los workers reciben un QueueHandler
+logger = logging.getLogger()
 
 # --- CARGA DE COORDENADAS DESDE ARCHIVO ---
+@lru_cache(maxsize=1)
 def cargar_coordenadas() -> Dict[str, Dict[str, float]]:
     """
-    Carga coordenadas desde archivo JSON externo.
+    Carga coordenadas desde archivo JSON externo (una vez por proceso, bajo demanda).
     Si no existe, usa coordenadas por defecto y las guarda.
     """
     coordenadas_default = {
@@ -101,28 +236,70 @@ def cargar_coordenadas() -> Dict[str, Dict[str, float]]:
         logger.error(f"Error cargando coordenadas: {e}. Usando valores por defecto.")
         return coordenadas_default
 
-COORDENADAS_CTD = cargar_coordenadas()
+@lru_cache(maxsize=1)
+def tablas_coordenadas():
+    """Diccionarios de búsqueda directa id -> lat / id -> lon (ids normalizados)"""
+    coordenadas = cargar_coordenadas()
+    lat = {k.strip().upper(): v['lat'] for k, v in coordenadas.items()}
+    lon = {k.strip().upper(): v['lon'] for k, v in coordenadas.items()}
+    return lat, lon
+
+# --- CACHÉ DE CABECERAS ---
+@lru_cache(maxsize=1)
+def cargar_cache_cabeceras() -> Dict[str, int]:
+    """
+    Carga la caché {archivo:mtime_ns:tamaño -> línea de cabecera} de ejecuciones previas.
+    Si el archivo cambia (mtime o tamaño), la clave deja de coincidir y se vuelve a detectar.
+    Se lee una vez por proceso y se devuelve siempre el mismo dict, que se actualiza en sitio.
+    """
+    try:
+        if config.HEADER_CACHE_FILE.exists():
+            with open(config.HEADER_CACHE_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    except Exception as e:
+        logger.warning(f"Caché de cabeceras ilegible ({e}). Se regenerará.")
+    return {}
+
+def guardar_cache_cabeceras():
+    """Persiste la caché de cabeceras para la próxima ejecución"""
+    try:
+        config.HEADER_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(config.HEADER_CACHE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(cargar_cache_cabeceras(), f, indent=2, ensure_ascii=False)
+    except Exception as e:
+        logger.warning(f"No se pudo guardar la caché de cabeceras: {e}")
+
+def clave_cache(filepath: Path) -> str:
+    st = filepath.stat()
+    return f"{filepath.name}:{st.st_mtime_ns}:{st.st_size}"
 
 # --- VALIDACIONES ---
 class DataValidator:
     """Clase para validar datos oceanográficos"""
     
     @staticmethod
-    def validar_rango(df: pd.DataFrame, col: str, min_val: float, max_val: float) -> pd.Series:
-        """Retorna máscara booleana de valores fuera de rango"""
+    def validar_rango(df: pd.DataFrame, col: str, min_val: float, max_val: float) -> np.ndarray:
+        """Retorna máscara booleana (NumPy) de valores fuera de rango"""
         if col not in df.columns:
-            return pd.Series([False] * len(df))
-        return (df[col] < min_val) | (df[col] > max_val)
+            return np.zeros(len(df), dtype=bool)
+        # Comparación directa sobre el array (NaN cuenta como dentro de rango)
+        arr = df[col].to_numpy(dtype=np.float32, na_value=np.nan)
+        return np.logical_or(arr < min_val, arr > max_val)
     
     @staticmethod
     def generar_reporte_calidad(df: pd.DataFrame) -> Dict:
         """Genera métricas de calidad del dataset"""
+        # Una sola pasada de isnull: de ella salen los nulos y las filas completas
+        total = len(df)
+        nulos = df.isnull()
+        nulos_por_columna = nulos.sum()
+        n_completos = int((~nulos.any(axis=1)).sum())
         reporte = {
-            'total_registros': len(df),
-            'registros_completos': df.dropna().shape[0],
-            'porcentaje_completo': (df.dropna().shape[0] / len(df) * 100) if len(df) > 0 else 0,
-            'nulos_por_columna': df.isnull().sum().to_dict(),
-            'porcentaje_nulos': (df.isnull().sum() / len(df) * 100).to_dict()
+            'total_registros': total,
+            'registros_completos': n_completos,
+            'porcentaje_completo': (n_completos / total * 100) if total > 0 else 0,
+            'nulos_por_columna': nulos_por_columna.to_dict(),
+            'porcentaje_nulos': (nulos_por_columna / total * 100).to_dict() if total > 0 else {}
         }
         
         # Validaciones de rango
@@ -145,46 +322,101 @@ def detectar_inicio_datos(filepath: Path) -> int:
     """
     Detecta la línea donde comienzan los datos (Header).
     Estrategia robusta: Evita acentos y busca patrones clave.
+    El resultado se cachea por (nombre, mtime, tamaño) entre ejecuciones.
     """
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-            
-            for i, line in enumerate(lines):
-                # Convertimos a minúsculas para comparar sin miedo
-                line_lower = line.lower().strip()
-                
-                # ESTRATEGIA 1: Buscar cabecera estándar
-                # Buscamos "odigo" (para saltar la tilde de Código) y "stacion"
-                if "odigo" in line_lower and "stacion" in line_lower:
-                    logger.debug(f"Header encontrado por patrón texto en línea {i}")
-                    return i
-                
-                # ESTRATEGIA 2: Buscar por variables (VAR_0, VAR_1...)
-                # A veces la cabecera es la línea que define las variables
-                if "var_0" in line_lower and "var_1" in line_lower:
-                    # En algunos formatos, la cabecera real está justo debajo de las variables
-                    # Verificamos la siguiente línea
-                    if i + 1 < len(lines) and "A0" in lines[i+1]:
-                        return i
-            
-            # ESTRATEGIA 3 (DESESPERADA): Buscar el primer dato (A0)
-            # Si encontramos "A0" al inicio de una línea, asumimos que la anterior es el header
-            for i, line in enumerate(lines):
-                if line.strip().startswith("A0") or line.strip().startswith("A1"):
-                    logger.warning(f"Header deducido (encontrado dato A0) en línea {i-1}")
-                    return max(0, i - 1)
-
-        logger.error(f"❌ NO SE ENCONTRÓ HEADER en {filepath.name}. Revisar manualmente.")
-        return -1 # Retornamos -1 para indicar fallo explícito
+        cache = cargar_cache_cabeceras()
+        clave = clave_cache(filepath)
+        if clave in cache:
+            logger.debug(f"Header de {filepath.name} tomado de caché (línea {cache[clave]})")
+            return cache[clave]
+        
+        start_line = _buscar_cabecera_rapido(filepath)
+        if start_line < 0:
+            start_line = _buscar_cabecera(filepath)
+        if start_line >= 0:
+            cache[clave] = start_line
+        return start_line
 
     except Exception as e:
         logger.error(f"Error leyendo {filepath.name}: {e}")
         return -1
 
+# La cabecera siempre está en las primeras líneas: basta con mirar este bloque
+_BLOQUE_CABECERA = 64 * 1024
+
+def _buscar_cabecera_rapido(filepath: Path) -> int:
+    """
+    Busca la cabecera estándar por bytes en los primeros 64 KB (sin decodificar ni
+    crear una str por línea). Devuelve -1 si no la encuentra ahí.
+    """
+    try:
+        with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            bloque = mm[:_BLOQUE_CABECERA].lower()
+    except ValueError:  # Archivo vacío: mmap no admite tamaño 0
+        return -1
+    
+    # "odigo" para saltar la tilde de Código (en bytes UTF-8 la ó no se pasa a minúscula)
+    idx = bloque.find(b'odigo')
+    if idx < 0:
+        return -1
+    inicio = bloque.rfind(b'\n', 0, idx) + 1
+    fin = bloque.find(b'\n', idx)
+    if b'stacion' not in bloque[inicio:fin if fin >= 0 else None]:
+        return -1
+    
+    linea = bloque.count(b'\n', 0, idx)
+    logger.debug(f"Header encontrado por patrón bytes en línea {linea}")
+    return linea
+
+def _buscar_cabecera(filepath: Path) -> int:
+    """
+    Recorre el archivo una sola vez recogiendo las señales de las tres estrategias
+    y corta en cuanto encuentra la cabecera (la de mayor prioridad).
+    """
+    with open(filepath, 'r', encoding='utf-8') as f:
+        candidato_var = None
+        primer_dato = None
+        
+        for i, line in enumerate(f):
+            # ESTRATEGIA 2 (cont.): la línea de variables solo vale si debajo hay datos
+            if candidato_var is not None and "A0" in line:
+                return candidato_var
+            candidato_var = None
+            
+            # Convertimos a minúsculas para comparar sin miedo
+            line_lower = line.lower().strip()
+            
+            # ESTRATEGIA 1: Buscar cabecera estándar
+            # Buscamos "odigo" (para saltar la tilde de Código) y "stacion"
+            if "odigo" in line_lower and "stacion" in line_lower:
+                logger.debug(f"Header encontrado por patrón texto en línea {i}")
+                return i
+            
+            # ESTRATEGIA 2: Buscar por variables (VAR_0, VAR_1...)
+            # A veces la cabecera es la línea que define las variables
+            # En algunos formatos, la cabecera real está justo debajo de las variables
+            if "var_0" in line_lower and "var_1" in line_lower:
+                candidato_var = i
+            
+            # ESTRATEGIA 3 (DESESPERADA): recordar el primer dato (A0/A1)
+            # Solo se usa si al terminar no apareció ninguna de las anteriores
+            if primer_dato is None:
+                stripped = line.strip()
+                if stripped.startswith("A0") or stripped.startswith("A1"):
+                    primer_dato = i
+    
+    # Si encontramos "A0" al inicio de una línea, asumimos que la anterior es el header
+    if primer_dato is not None:
+        logger.warning(f"Header deducido (encontrado dato A0) en línea {primer_dato-1}")
+        return max(0, primer_dato - 1)
+
+    logger.error(f"❌ NO SE ENCONTRÓ HEADER en {filepath.name}. Revisar manualmente.")
+    return -1 # Retornamos -1 para indicar fallo explícito
+
 def enriquecer_coordenadas(df: pd.DataFrame) -> pd.DataFrame:
     """
-    Añade coordenadas geográficas usando merge (más eficiente que apply).
+    Añade coordenadas geográficas con map sobre diccionarios (sin merge ni columnas auxiliares).
     """
     if 'estacion_id' not in df.columns:
         logger.warning("Columna 'estacion_id' no encontrada. Saltando enriquecimiento geográfico.")
@@ -192,30 +424,17 @@ def enriquecer_coordenadas(df: pd.DataFrame) -> pd.DataFrame:
         df['lon'] = None
         return df
     
-    # Crear DataFrame de coordenadas
-    coords_df = pd.DataFrame([
-        {'estacion_id': k, 'lat': v['lat'], 'lon': v['lon']}
-        for k, v in COORDENADAS_CTD.items()
-    ])
-    
     # Limpiar IDs para mejor matching
-    df['estacion_id_clean'] = df['estacion_id'].astype(str).str.strip().str.upper()
-    coords_df['estacion_id_clean'] = coords_df['estacion_id'].str.strip().str.upper()
-    
-    # Merge
-    df = df.merge(
-        coords_df[['estacion_id_clean', 'lat', 'lon']],
-        on='estacion_id_clean',
-        how='left'
-    )
+    sid = df['estacion_id'].astype(str).str.strip().str.upper()
+    lat, lon = tablas_coordenadas()
+    df['lat'] = sid.map(lat).astype('float64')
+    df['lon'] = sid.map(lon).astype('float64')
     
     # Reportar estaciones sin coordenadas
-    sin_coords = df[df['lat'].isnull()]['estacion_id'].unique()
+    sin_coords = df.loc[df['lat'].isnull(), 'estacion_id'].unique()
     if len(sin_coords) > 0:
         logger.warning(f"Estaciones sin coordenadas: {list(sin_coords)}")
     
-    df = df.drop(columns=['estacion_id_clean'])
-    
     return df
 
 def procesar_archivo_ctd(filepath: Path) -> Optional[pd.DataFrame]:
@@ -243,16 +462,30 @@ def procesar_archivo_ctd(filepath: Path) -> Optional[pd.DataFrame]:
     try:
         # Leer con advertencias capturadas
         with pd.option_context('mode.chained_assignment', None):
-            df = pd.read_csv(
-                filepath,
-                skiprows=start_line,
-                sep='\t',
-                encoding='utf-8',
-                decimal=',',
-                # low_memory=False,  <-- ELIMINADA CORRECTAMENTE
-                engine='python',
-                on_bad_lines='warn' 
-            )
+            try:
+                # Parser C con tipos explícitos (rápido, sin strings intermedios por campo)
+                df = pd.read_csv(
+                    filepath,
+                    skiprows=start_line,
+                    sep='\t',
+                    encoding='utf-8',
+                    decimal=',',
+                    engine='c',
+                    dtype=DTYPES_RAW,
+                    on_bad_lines='warn'
+                )
+            except ValueError as e:
+                # Valores no numéricos o líneas mal formadas: parser Python tolerante
+                logger.warning(f"Parser C falló en {filename} ({e}). Reintentando con engine='python'")
+                df = pd.read_csv(
+                    filepath,
+                    skiprows=start_line,
+                    sep='\t',
+                    encoding='utf-8',
+                    decimal=',',
+                    engine='python',
+                    on_bad_lines='warn'
+                )
         
         logger.info(f"Leídas {len(df)} filas del archivo raw")
         
@@ -272,48 +505,22 @@ def procesar_archivo_ctd(filepath: Path) -> Optional[pd.DataFrame]:
     df.columns = df.columns.str.strip()
     logger.info(f"Columnas originales: {list(df.columns)}")
     
-    df.columns = df.columns.str.strip()
-    
-    rename_map = {
-        # Identificadores
-        'Código': 'estacion_id',
-        'Estacion': 'estacion_nombre',
-        'Data': 'fecha_hora',
-        
-        # Variables Físico-Químicas
-        'VAR_0': 'temperatura',
-        'VAR_1': 'salinidad',
-        'VAR_2': 'presion_db',        # Decibares
-        'VAR_3': 'ph',
-        'VAR_4': 'oxigeno_ml_l',      # ml/l
-        'VAR_5': 'transmitancia',
-        'VAR_6': 'irradiancia',
-        'VAR_7': 'fluorescencia_uv',
-        'VAR_8': 'fluorescencia',     # Clorofila
-        'VAR_9': 'densidad',          # Sigma-T
-        'VAR_10': 'profundidad',
-        'VAR_11': 'temperatura_its68',
-        'VAR_12': 'conductividad',
-        
-        # Control de Calidad (QC) - Mapeamos los más críticos
-        'CODVAL_0': 'qc_temperatura',
-        'CODVAL_1': 'qc_salinidad',
-        'CODVAL_4': 'qc_oxigeno',
-        'CODVAL_8': 'qc_fluorescencia'
-    }
-    
     # Solo renombrar columnas que existan
-    rename_map_existentes = {k: v for k, v in rename_map.items() if k in df.columns}
+    cols = set(df.columns)
+    rename_map_existentes = {k: v for k, v in RENAME_MAP.items() if k in cols}
     df = df.rename(columns=rename_map_existentes)
+    # Conjunto de columnas presentes: se actualiza tras cada paso que las cambia
+    cols = set(df.columns)
     
-    columnas_faltantes = set(rename_map.keys()) - set(rename_map_existentes.keys())
+    columnas_faltantes = RENAME_MAP.keys() - rename_map_existentes.keys()
     if columnas_faltantes:
         logger.warning(f"Columnas esperadas no encontradas: {columnas_faltantes}")
     
     # 4. PARSEO DE TIPOS
-    cols_numericas = ['salinidad', 'profundidad', 'temperatura', 'qc_salinidad', 'qc_temperatura']
+    # Todas las variables y QC: el esquema de salida es numérico
+    cols_numericas = COLS_FLOAT32 + COLS_QC
     for col in cols_numericas:
-        if col in df.columns:
+        if col in cols:
             antes = df[col].notna().sum()
             df[col] = pd.to_numeric(df[col], errors='coerce')
             despues = df[col].notna().sum()
@@ -321,42 +528,62 @@ def procesar_archivo_ctd(filepath: Path) -> Optional[pd.DataFrame]:
             if perdidos > 0:
                 logger.warning(f"Columna '{col}': {perdidos} valores no numéricos convertidos a NaN")
     
+    # Reducir tipos (el parser C ya trae las variables en float32; el parser Python no)
+    for col in COLS_FLOAT32:
+        if col in cols:
+            df[col] = df[col].astype('float32')
+    for col in COLS_QC:
+        if col in cols:
+            antes = df[col].notna().sum()
+            df[col] = a_codigo_qc(df[col])
+            invalidos = antes - df[col].notna().sum()
+            if invalidos > 0:
+                logger.warning(f"Columna '{col}': {invalidos} códigos QC fuera de {RANGO_QC} convertidos a nulo")
+    
     # 5. MERGE GEOGRÁFICO
     df = enriquecer_coordenadas(df)
+    cols = set(df.columns)
     
     # 6. FORMATO FECHA
-    if 'fecha_hora' in df.columns:
+    if 'fecha_hora' in cols:
         antes = df['fecha_hora'].notna().sum()
-        df['fecha_hora'] = pd.to_datetime(df['fecha_hora'], dayfirst=True, errors='coerce')
+        # Con formato explícito pandas usa el parser vectorizado en vez de dateutil
+        validas = df['fecha_hora'].dropna()
+        fmt = detectar_formato_fecha(str(validas.iloc[0])) if len(validas) else None
+        if fmt:
+            df['fecha_hora'] = pd.to_datetime(df['fecha_hora'].str.strip(), format=fmt, errors='coerce', cache=True)
+        else:
+            logger.warning(f"Formato de fecha no reconocido en {filename}. Usando inferencia (lenta)")
+            df['fecha_hora'] = pd.to_datetime(df['fecha_hora'], dayfirst=True, errors='coerce')
         despues = df['fecha_hora'].notna().sum()
         perdidos = antes - despues
         if perdidos > 0:
             logger.warning(f"Fechas inválidas: {perdidos} valores convertidos a NaT")
     
    # 7. METADATOS Y LIMPIEZA FINAL
+    # La fecha de procesamiento es una por ejecución: va en los metadatos del Parquet
     df['origen_archivo'] = filename
-    df['fecha_procesamiento'] = pd.Timestamp.now()
+    cols.add('origen_archivo')
     
     # Quitar espacios en IDs (ej: "A0   " -> "A0")
-    if 'estacion_id' in df.columns:
+    if 'estacion_id' in cols:
         df['estacion_id'] = df['estacion_id'].astype(str).str.strip()
 
     # REORDENAMIENTO INTELIGENTE
     # Ponemos las columnas clave primero, y luego el resto de variables que existan
-    cols_clave = ['estacion_id', 'estacion_nombre', 'lat', 'lon', 'fecha_hora', 'profundidad', 'salinidad', 'qc_salinidad', 'temperatura', 'qc_temperatura']
-    
     # Detectamos qué otras columnas útiles tenemos (ph, oxigeno, etc.)
-    cols_extra = [c for c in df.columns if c not in cols_clave and c in rename_map.values()]
+    cols_extra = [c for c in df.columns if c not in COLS_CLAVE and c in RENAME_VALUES]
     
-    # Metadatos al final
-    cols_meta = ['origen_archivo', 'fecha_procesamiento']
-    
-    # Construimos la lista final asegurando que existan
-    cols_finales = [c for c in cols_clave if c in df.columns] + \
-                   [c for c in cols_extra if c in df.columns] + \
-                   cols_meta
+    # Construimos la lista final asegurando que existan (metadatos al final)
+    cols_finales = [c for c in COLS_CLAVE if c in cols] + \
+                   cols_extra + \
+                   list(COLS_META)
                    
     df = df[cols_finales]
+    
+    for col in COLS_CATEGORIA:
+        if col in cols:
+            df[col] = df[col].astype('category')
 
     # 8. REPORTE DE CALIDAD
     reporte = DataValidator.generar_reporte_calidad(df)
@@ -366,9 +593,27 @@ def procesar_archivo_ctd(filepath: Path) -> Optional[pd.DataFrame]:
     
     return df
 
+def procesar_archivo_seguro(filepath: Path) -> Optional[pd.DataFrame]:
+    """Versión para el pool: un error inesperado marca el archivo como fallido sin parar el resto"""
+    try:
+        return procesar_archivo_ctd(filepath)
+    except Exception as e:
+        logger.error(f"Error inesperado procesando {filepath.name}: {e}", exc_info=True)
+        return None
+
+def _init_worker(log_queue):
+    """Redirige el logging del proceso hijo a la cola que escribe el proceso principal"""
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(logging.DEBUG)
+
 # --- MAIN MEJORADO ---
 def main():
     """Función principal con manejo robusto de errores"""
+    setup_logging()
     logger.info(f"{'#'*80}")
     logger.info(f"INICIANDO PROCESAMIENTO CTD - Ría de Arousa")
     logger.info(f"Timestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
@@ -384,7 +629,8 @@ def main():
     
     # Buscar archivos
     try:
-        archivos = list(config.INPUT_PATH.glob("*.txt"))
+        # Orden fijo: la salida se escribe en este orden, sea cual sea el worker que acabe antes
+        archivos = sorted(config.INPUT_PATH.glob("*.txt"))
         logger.info(f"Encontrados {len(archivos)} archivos .txt en {config.INPUT_PATH}")
         
         if not archivos:
@@ -394,68 +640,136 @@ def main():
         logger.critical(f"Error buscando archivos: {e}")
         return
     
-    # Procesar archivos
-    dfs_procesados = []
-    archivos_fallidos = []
-    
-    for i, filepath in enumerate(archivos, 1):
-        logger.info(f"\n[{i}/{len(archivos)}] Procesando archivo...")
-        df_temp = procesar_archivo_ctd(filepath)
-        
-        if df_temp is not None and not df_temp.empty:
-            dfs_procesados.append(df_temp)
-            logger.info(f" Archivo procesado exitosamente")
-        else:
-            archivos_fallidos.append(filepath.name)
-            logger.error(f" Archivo falló el procesamiento")
+    # Detectar cabeceras aquí (rápido y con caché) y persistirlas antes de lanzar
+    # los workers: así cada proceso hijo las encuentra ya en la caché
+    for filepath in archivos:
+        detectar_inicio_datos(filepath)
+    guardar_cache_cabeceras()
+    # Cargar coordenadas antes del pool: con fork los workers las heredan ya leídas
+    tablas_coordenadas()
     
-    # Consolidar resultados
-    if not dfs_procesados:
-        logger.critical(" NINGÚN ARCHIVO SE PROCESÓ EXITOSAMENTE")
-        return
+    outfile = config.OUTPUT_PATH / config.OUTPUT_FILE
+    csv_file = outfile.with_suffix('.csv')
+    if config.EMIT_CSV and csv_file.exists():
+        csv_file.unlink()  # El CSV se escribe en modo append, archivo a archivo
     
-    logger.info(f"\n{'='*80}")
-    logger.info(f"CONSOLIDANDO DATOS")
-    logger.info(f"{'='*80}")
+    # Procedencia de la ejecución como metadatos del archivo, no como columna por fila
+    esquema = ESQUEMA_SALIDA.with_metadata({'fecha_procesamiento': datetime.now().isoformat()})
     
+    archivos_fallidos = []
+    n_procesados = 0
+    total_registros = 0
+    registros_completos = 0
+    fecha_min, fecha_max = pd.NaT, pd.NaT
+    estaciones = set()
+    muestra = None
+    ultima_fecha = None  # Fecha máxima ya escrita (NaT si quedaron fechas nulas al final)
+    requiere_orden_global = False
+    
+    # Procesar archivos en paralelo (cada archivo es independiente y CPU-bound)
+    # Los logs de los workers pasan por una cola: solo este proceso escribe el log
+    log_queue = multiprocessing.Queue(-1)
+    listener = logging.handlers.QueueListener(
+        log_queue, *logging.getLogger().handlers, respect_handler_level=True
+    )
+    listener.start()
     try:
-        master_df = pd.concat(dfs_procesados, ignore_index=True)
-        logger.info(f"Total registros consolidados: {len(master_df):,}")
-        
-        # Ordenar
-        if 'fecha_hora' in master_df.columns:
-            master_df = master_df.sort_values(by=['fecha_hora', 'estacion_id'])
-            logger.info("Datos ordenados por fecha y estación")
-        
-        # Guardar
-        outfile = config.OUTPUT_PATH / config.OUTPUT_FILE
-        master_df.to_csv(outfile, index=False, sep=';', decimal='.', encoding='utf-8')
-        
-        logger.info(f"\n{'='*80}")
-        logger.info(f" PROCESAMIENTO COMPLETADO EXITOSAMENTE")
-        logger.info(f"{'='*80}")
-        logger.info(f"Archivo guardado: {outfile.absolute()}")
-        logger.info(f"Tamaño del archivo: {outfile.stat().st_size / 1024 / 1024:.2f} MB")
-        logger.info(f"Archivos procesados: {len(dfs_procesados)}/{len(archivos)}")
-        
-        if archivos_fallidos:
-            logger.warning(f"Archivos fallidos: {archivos_fallidos}")
-        
-        # Reporte final de calidad
-        reporte_final = DataValidator.generar_reporte_calidad(master_df)
-        logger.info(f"\n REPORTE DE CALIDAD FINAL:")
-        logger.info(f"  - Registros totales: {reporte_final['total_registros']:,}")
-        logger.info(f"  - Registros completos: {reporte_final['registros_completos']:,} ({reporte_final['porcentaje_completo']:.1f}%)")
-        logger.info(f"  - Rango temporal: {master_df['fecha_hora'].min()} a {master_df['fecha_hora'].max()}")
-        logger.info(f"  - Estaciones únicas: {master_df['estacion_id'].nunique()}")
-        
-        # Mostrar muestra
-        print("\n📋 MUESTRA DE DATOS:")
-        print(master_df.head(10).to_string())
-        
+        n_workers = min(len(archivos), os.cpu_count() or 1)
+        # Cada resultado se escribe y se descarta en el orden de `archivos` (ex.map
+        # guarda los que terminan antes): no se acumula todo el histórico en memoria
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(log_queue,)) as ex, \
+             pq.ParquetWriter(outfile, esquema, compression='snappy') as writer:
+            resultados = ex.map(procesar_archivo_seguro, archivos)
+            for i, (filepath, df_temp) in enumerate(zip(archivos, resultados), 1):
+                if df_temp is None or df_temp.empty:
+                    archivos_fallidos.append(filepath.name)
+                    logger.error(f"[{i}/{len(archivos)}] {filepath.name}: falló el procesamiento")
+                    continue
+                
+                # Ordenar por fecha y estación dentro del archivo
+                if 'fecha_hora' in df_temp.columns:
+                    df_temp = df_temp.sort_values(by=['fecha_hora', 'estacion_id'])
+                
+                try:
+                    tabla = a_tabla_salida(df_temp)
+                except Exception as e:
+                    archivos_fallidos.append(filepath.name)
+                    logger.error(f"[{i}/{len(archivos)}] {filepath.name}: no encaja en el esquema de salida ({e})")
+                    continue
+                
+                if 'fecha_hora' in df_temp.columns:
+                    # Si este archivo empieza antes de donde acabó el anterior, el
+                    # histórico no queda cronológico y hará falta una ordenación final
+                    fechas = df_temp['fecha_hora']
+                    if ultima_fecha is not None and (pd.isna(ultima_fecha) or fechas.min() <= ultima_fecha):
+                        requiere_orden_global = True
+                    ultima_fecha = pd.NaT if fechas.isna().any() else fechas.max()
+                
+                writer.write_table(tabla)
+                if config.EMIT_CSV:
+                    a_float64_csv(df_temp.reindex(columns=ESQUEMA_SALIDA.names)).to_csv(
+                        csv_file, mode='a', header=(n_procesados == 0),
+                        index=False, sep=';', decimal='.', encoding='utf-8'
+                    )
+                
+                # Resumen acumulado para el reporte final
+                n_procesados += 1
+                total_registros += len(df_temp)
+                registros_completos += int(df_temp.notna().all(axis=1).sum())
+                if 'fecha_hora' in df_temp.columns:
+                    fecha_min = min(fecha_min, df_temp['fecha_hora'].min()) if pd.notna(fecha_min) else df_temp['fecha_hora'].min()
+                    fecha_max = max(fecha_max, df_temp['fecha_hora'].max()) if pd.notna(fecha_max) else df_temp['fecha_hora'].max()
+                if 'estacion_id' in df_temp.columns:
+                    estaciones.update(df_temp['estacion_id'].dropna().unique())
+                if muestra is None:
+                    muestra = df_temp.head(10)
+                
+                logger.info(f"[{i}/{len(archivos)}] {filepath.name}: procesado exitosamente ({len(df_temp):,} registros)")
+                del df_temp
     except Exception as e:
         logger.critical(f"Error fatal en consolidación: {e}", exc_info=True)
+        # No dejar un histórico truncado que parezca completo
+        outfile.unlink(missing_ok=True)
+        if config.EMIT_CSV:
+            csv_file.unlink(missing_ok=True)
         return
+    finally:
+        listener.stop()
+    
+    if n_procesados == 0:
+        outfile.unlink(missing_ok=True)
+        logger.critical(" NINGÚN ARCHIVO SE PROCESÓ EXITOSAMENTE")
+        return
+    
+    if requiere_orden_global:
+        logger.info("Archivos solapados en el tiempo: ordenando el histórico completo...")
+        ordenar_salida_global(outfile, csv_file, esquema)
+    
+    logger.info(f"\n{'='*80}")
+    logger.info(f" PROCESAMIENTO COMPLETADO EXITOSAMENTE")
+    logger.info(f"{'='*80}")
+    logger.info(f"Total registros consolidados: {total_registros:,}")
+    logger.info(f"Archivo guardado: {outfile.absolute()}")
+    logger.info(f"Tamaño del archivo: {outfile.stat().st_size / 1024 / 1024:.2f} MB")
+    if config.EMIT_CSV:
+        logger.info(f"Copia CSV guardada: {csv_file.absolute()}")
+    logger.info(f"Archivos procesados: {n_procesados}/{len(archivos)}")
+    
+    if archivos_fallidos:
+        logger.warning(f"Archivos fallidos: {archivos_fallidos}")
+    
+    # Reporte final de calidad
+    porcentaje_completo = registros_completos / total_registros * 100 if total_registros else 0
+    logger.info(f"\n REPORTE DE CALIDAD FINAL:")
+    logger.info(f"  - Registros totales: {total_registros:,}")
+    logger.info(f"  - Registros completos: {registros_completos:,} ({porcentaje_completo:.1f}%)")
+    logger.info(f"  - Rango temporal: {fecha_min} a {fecha_max}")
+    logger.info(f"  - Estaciones únicas: {len(estaciones)}")
+    
+    # Mostrar muestra
+    print("\n📋 MUESTRA DE DATOS:")
+    print(muestra.to_string())
 
 if __name__ == "__main__":
     try:
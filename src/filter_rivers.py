@@ -1,27 +1,28 @@
 # src/filter_rivers.py
 import os
+import re
 import sys
 from pathlib import Path
 
 # --- 🚑 ARREGLO DE EMERGENCIA PARA PROJ (WINDOWS) ---
-# Esto debe ir ANTES de importar geopandas
-try:
-    # Detectamos dónde está instalado tu entorno Conda
-    conda_prefix = sys.prefix
-    
-    # Rutas posibles donde Conda guarda los datos de proyección en Windows
-    # Usualmente es: .../Library/share/proj
-    proj_lib = Path(conda_prefix) / "Library" / "share" / "proj"
-    
-    # Forzamos la variable de entorno
-    os.environ["PROJ_LIB"] = str(proj_lib)
-    print(f"🔧 PROJ_LIB forzada a: {proj_lib}")
-except Exception as e:
-    print(f"⚠️ No pude aplicar el parche de PROJ: {e}")
+# Datos de proyección del entorno Conda en Windows: .../Library/share/proj
+# Se fijan directamente en pyproj (PROJ_LIB no sirve si PROJ ya arrancó)
+# y solo cuando pyproj no encuentra por sí mismo una carpeta válida
+PROJ_DIR_CONDA = Path(sys.prefix) / "Library" / "share" / "proj"
+if os.name == 'nt':
+    import pyproj
+    try:
+        proj_actual = pyproj.datadir.get_data_dir()
+    except pyproj.exceptions.DataDirError:
+        proj_actual = ""
+    if not proj_actual.endswith("proj") and PROJ_DIR_CONDA.is_dir():
+        pyproj.datadir.set_data_dir(str(PROJ_DIR_CONDA))
+        print(f"🔧 Datos de PROJ forzados a: {PROJ_DIR_CONDA}")
 
 # Ahora sí importamos las librerías geoespaciales
 import geopandas as gpd
 import matplotlib.pyplot as plt
+import pyogrio
 
 # --- CONFIGURACIÓN ---
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -47,31 +48,39 @@ def procesar_rios():
     print(f"🗺️  Procesando archivo: {input_file.name}")
     
     try:
-        # Carga del Shapefile
-        gdf = gpd.read_file(input_file)
-        print(f"✅ Cargado. Geometrías totales: {len(gdf)}")
+        # Solo metadatos (campos y nº de geometrías): no se lee ninguna geometría
+        info = pyogrio.read_info(input_file)
+        columnas = list(info['fields'])
+        total = info['features']
+        print(f"✅ Abierto. Geometrías totales: {total}")
         
         # 2. Detección automática de columna de nombre
         col_nombre = None
         # He añadido 'nombre' en minúsculas para que te lo detecte solo
         candidatos = ['NOME', 'NOMBRE', 'nombre', 'RIO', 'TEXTO']
         for c in candidatos:
-            if c in gdf.columns:
+            if c in columnas:
                 col_nombre = c
                 break
         
         if not col_nombre:
-            print(f"⚠️ No detecté columna de nombre. Columnas disponibles: {gdf.columns.tolist()}")
+            print(f"⚠️ No detecté columna de nombre. Columnas disponibles: {columnas}")
             col_nombre = input("👉 Escribe el nombre de la columna manualmente: ")
         else:
             print(f"🎯 Filtrando por columna detectada: '{col_nombre}'")
 
         # 3. Filtrado por Cuenca (Ulla, Umia, Sar)
+        # El filtro va a OGR como SQL: del disco solo se leen los tramos que cumplen
+        # (LIKE en OGR SQL no distingue mayúsculas)
         keywords = ['ULLA', 'UMIA', 'SAR']
-        filtro = gdf[col_nombre].astype(str).str.upper().apply(lambda x: any(k in x for k in keywords))
+        where = " OR ".join(f"\"{col_nombre}\" LIKE '%{k}%'" for k in keywords)
+        gdf = pyogrio.read_dataframe(input_file, where=where)
+        # Red de seguridad por si el driver no soporta el filtro: regex compilada en C, no lambda por fila
+        patron = re.compile("|".join(keywords), re.IGNORECASE)
+        filtro = gdf[col_nombre].astype('string').str.contains(patron, na=False)
         gdf_filtered = gdf[filtro].copy()
         
-        print(f"💧 Tramos seleccionados: {len(gdf_filtered)} de {len(gdf)}")
+        print(f"💧 Tramos seleccionados: {len(gdf_filtered)} de {total}")
 
         if gdf_filtered.empty:
             print("⚠️ El filtro devolvió 0 ríos. Revisa los keywords.")
@@ -86,6 +95,8 @@ def procesar_rios():
         # 5. Guardado
         gdf_filtered.to_file(output_file, driver='GeoJSON')
         print(f"💾 Archivo limpio guardado en: {output_file}")
+        # Copia en FlatGeobuf (con índice espacial): permite leer solo los tramos de una caja
+        gdf_filtered.to_file(output_file.with_suffix('.fgb'), driver='FlatGeobuf')
 
         # 6. Visualización
         print("🖼️  Generando mapa...")
@@ -34,10 +34,7 @@ def descargar_lista_aforos():
             print(f"Claves encontradas: {data.keys()}")
             return
 
-        # Convertimos a DataFrame
-        df = pd.DataFrame(estaciones)
-        
-        print(f"✅ Descargados datos de {len(df)} estaciones activas.")
+        print(f"✅ Descargados datos de {len(estaciones)} estaciones activas.")
         
         # --- LIMPIEZA DE COLUMNAS ---
         # Este endpoint trae datos mezclados con metadatos.
@@ -46,8 +43,11 @@ def descargar_lista_aforos():
         cols_deseadas = ['idEstacion', 'nomeEstacion', 'lat', 'lon', 'concello', 'provincia']
         
         # Filtramos solo las que existan en el JSON recibido
-        cols_finales = [c for c in cols_deseadas if c in df.columns]
-        df_meta = df[cols_finales].drop_duplicates()
+        claves = set().union(*estaciones)
+        cols_finales = [c for c in cols_deseadas if c in claves]
+        
+        # Convertimos a DataFrame solo esas columnas (no todas las lecturas del endpoint)
+        df_meta = pd.DataFrame(estaciones, columns=cols_finales).drop_duplicates()
 
         # --- FILTRADO TFM (Ría de Arousa) ---
         # Filtramos por ríos Ulla, Umia, Sar o concellos clave
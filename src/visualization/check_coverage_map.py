@@ -1,4 +1,10 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import dask
+import numpy as np
 import xarray as xr
+import matplotlib
+matplotlib.use('Agg')  # Solo se guarda el PNG: backend sin ventana
 import matplotlib.pyplot as plt
 import os
 from pathlib import Path
@@ -9,6 +15,67 @@ import glob
 # ==========================================
 DATA_DIR = Path("data/raw/b3/wrf_prec")
 AROUSA_COORDS = {'lat': 42.50, 'lon': -8.90}
+PASOS_POR_BLOQUE = 64  # Pasos de tiempo (aprox.) que se leen y suman de cada vez
+# Revisar los límites de TODOS los .nc (no solo el de muestra): lee cada archivo del
+# histórico, así que solo se hace con CHECK_ALL=1
+CHECK_ALL = os.getenv("CHECK_ALL") == "1"
+MAX_HILOS = 8  # Lecturas de coordenadas en paralelo con CHECK_ALL
+
+# Trocea los paths largos en Agg (acelera el renderizado de líneas densas)
+plt.rcParams['agg.path.chunksize'] = 10000
+
+def limites_ds(d):
+    """(lat_min, lat_max, lon_min, lon_max) de un dataset abierto"""
+    # Las cuatro reducciones en un único grafo dask (o directas si lat/lon no van por bloques)
+    return tuple(float(v) for v in dask.compute(
+        d['lat'].min(), d['lat'].max(), d['lon'].min(), d['lon'].max()
+    ))
+
+def limites(path):
+    """Devuelve los límites de un archivo, o None si no se puede leer."""
+    try:
+        # Solo se leen lat/lon: sin decodificar CF ni tocar la variable de datos
+        with xr.open_dataset(path, engine='h5netcdf', decode_cf=False) as d:
+            return limites_ds(d)
+    except Exception as e:
+        print(f"No se pudieron leer las coordenadas de {Path(path).name}: {e}")
+        return None
+
+def chunks_alineados(var):
+    """
+    Chunks dask que coinciden con los chunks HDF5 del archivo: cada bloque lee
+    chunks enteros del disco. En tiempo se agrupan tantos como quepan en
+    PASOS_POR_BLOQUE (al menos uno).
+    """
+    tam = var.encoding.get('chunksizes')
+    if not tam:  # Almacenamiento contiguo: no hay chunks con los que alinearse
+        return {'time': PASOS_POR_BLOQUE}
+    chunks = dict(zip(var.dims, tam))
+    chunks['time'] = max(1, PASOS_POR_BLOQUE // chunks['time']) * chunks['time']
+    return chunks
+
+def cubre_arousa(lim):
+    lat_min, lat_max, lon_min, lon_max = lim
+    return (lat_min < AROUSA_COORDS['lat'] < lat_max and
+            lon_min < AROUSA_COORDS['lon'] < lon_max)
+
+def revisar_todos(files):
+    """
+    Comprueba con varios hilos que cada archivo cubre la Ría.
+    h5py serializa las llamadas HDF5 con un lock global: los hilos solapan sobre todo
+    la latencia del sistema de archivos y el overhead de Python, no las lecturas.
+    """
+    print(f"Comprobando límites de {len(files)} archivos...")
+    with ThreadPoolExecutor(max_workers=min(MAX_HILOS, len(files))) as ex:
+        todos_limites = list(ex.map(limites, files))
+
+    fuera = [p.name for p, lim in zip(files, todos_limites) if lim is not None and not cubre_arousa(lim)]
+    ilegibles = [p.name for p, lim in zip(files, todos_limites) if lim is None]
+    print(f"Archivos que cubren la Ría: {len(files) - len(fuera) - len(ilegibles)}/{len(files)}")
+    if fuera:
+        print(f"ALERTA: {len(fuera)} archivos no cubren la zona de estudio (p. ej. {fuera[0]})")
+    if ilegibles:
+        print(f"ALERTA: {len(ilegibles)} archivos no se pudieron leer")
 
 def main():
     print(f"Buscando archivos NetCDF en: {DATA_DIR}")
@@ -20,38 +87,75 @@ def main():
         print("Error: No hay archivos .nc descargados en la carpeta de datos.")
         return
 
+    if CHECK_ALL:
+        revisar_todos(files)
+
     # Tomamos el último archivo encontrado (suele ser el más reciente)
     file_path = files[-1]
     print(f"Analizando archivo de muestra: {file_path.name}")
 
     try:
-        ds = xr.open_dataset(file_path)
+        # Apertura perezosa por bloques (dask): la suma se hace bloque a bloque
+        # sin cargar el cubo completo en memoria
+        # h5netcdf y sin mask_and_scale: no se desempaqueta el cubo entero a float64;
+        # el relleno y la escala se aplican a mano sobre la suma (tiempos sí se decodifican)
+        ds = xr.open_dataset(file_path, engine='h5netcdf', mask_and_scale=False)
+        # Bloques alineados con los chunks del archivo (leídos de encoding, sin abrirlo dos veces)
+        paso = PASOS_POR_BLOQUE
+        if 'prec' in ds:
+            chunks = chunks_alineados(ds['prec'])
+            paso = chunks['time']
+            ds = ds.chunk(chunks)
         
-        # Validación Numérica
-        lats = ds['lat'].values
-        lons = ds['lon'].values
+        # Validación Numérica (solo el archivo de muestra)
+        lim = limites_ds(ds)
+        lat_min, lat_max, lon_min, lon_max = lim
         
         print("-" * 40)
-        print(f"Límites Latitud:  {lats.min():.4f} <-> {lats.max():.4f}")
-        print(f"Límites Longitud: {lons.min():.4f} <-> {lons.max():.4f}")
+        print(f"Límites Latitud:  {lat_min:.4f} <-> {lat_max:.4f}")
+        print(f"Límites Longitud: {lon_min:.4f} <-> {lon_max:.4f}")
         print("-" * 40)
         
-        in_lat = lats.min() < AROUSA_COORDS['lat'] < lats.max()
-        in_lon = lons.min() < AROUSA_COORDS['lon'] < lons.max()
-        
-        if in_lat and in_lon:
+        if cubre_arousa(lim):
             print("ÉXITO: La Ría de Arousa está dentro del grid.")
         else:
             print("ALERTA CRÍTICA: La zona de estudio está FUERA del archivo.")
 
         # Visualización
         print("Generando mapa de comprobación...")
-        plt.figure(figsize=(10, 8))
+        fig, ax = plt.subplots(figsize=(10, 8))
         
         # Ploteamos la suma total de lluvia del archivo para que se vea mejor el mapa
         if 'prec' in ds:
-            total_prec = ds['prec'].sum(dim='time')
-            total_prec.plot(x='lon', y='lat', cmap='Blues', cbar_kwargs={'label': 'Lluvia Total (mm)'})
+            # Acumulador 2D en float32: en memoria solo hay un bloque de tiempo a la vez
+            prec = ds['prec']
+            relleno = prec.attrs.get('_FillValue', prec.attrs.get('missing_value'))
+            escala = prec.attrs.get('scale_factor', 1.0)
+            offset = prec.attrs.get('add_offset', 0.0)
+            
+            plantilla = prec.isel(time=0, drop=True)  # Dimensiones y coords del mapa
+            acc = np.zeros(plantilla.shape, dtype=np.float32)
+            n_validos = np.zeros(plantilla.shape, dtype=np.int32) if offset else None
+            for t0 in range(0, prec.sizes['time'], paso):
+                bloque = prec.isel(time=slice(t0, t0 + paso))
+                validos = bloque != relleno if relleno is not None else bloque.notnull()
+                # Suma directamente en float32 (mitad de ancho de banda si el dato viene en float64)
+                acc += bloque.where(validos, 0).sum(dim='time', dtype=np.float32).values
+                if n_validos is not None:
+                    n_validos += validos.sum(dim='time').values
+            
+            # sum(x*escala + offset) = escala*sum(x) + n*offset: un escalado 2D en vez del cubo
+            acc *= escala
+            if n_validos is not None:
+                acc += n_validos * np.float32(offset)
+            total_prec = plantilla.copy(data=acc).transpose(*ds['lat'].dims, ...)
+            
+            # pcolormesh rasterizado: la malla se guarda como una imagen, no como un polígono por celda
+            malla = ax.pcolormesh(ds['lon'].values, ds['lat'].values, total_prec.values,
+                                  cmap='Blues', shading='nearest', rasterized=True)
+            fig.colorbar(malla, ax=ax, label='Lluvia Total (mm)')
+            ax.set_xlabel('lon')
+            ax.set_ylabel('lat')
         
         plt.plot(AROUSA_COORDS['lon'], AROUSA_COORDS['lat'], 'ro', markersize=10, label='Ría de Arousa')
         plt.legend()
@@ -61,6 +165,7 @@ def main():
         output_img = "check_coverage.png"
         plt.savefig(output_img)
         print(f"Mapa guardado: {output_img}")
+        plt.close(fig)  # Libera el buffer de la figura
 
     except Exception as e:
         print(f"Error procesando el archivo: {e}")
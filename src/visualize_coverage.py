@@ -1,28 +1,108 @@
 # src/visualize_coverage.py
+import hashlib
 import os
 import sys
 from pathlib import Path
 
 # --- 1. ARREGLO PROJ (Solo Windows) ---
-try:
-    if os.name == 'nt': 
-        conda_prefix = sys.prefix
-        proj_lib = Path(conda_prefix) / "Library" / "share" / "proj"
-        os.environ["PROJ_LIB"] = str(proj_lib)
-except Exception:
-    pass
+# Datos de PROJ del entorno Conda; se fijan una vez en pyproj (no vía PROJ_LIB)
+# y solo si pyproj no encuentra ya una carpeta válida
+PROJ_DIR_CONDA = Path(sys.prefix) / "Library" / "share" / "proj"
+if os.name == 'nt':
+    import pyproj
+    try:
+        proj_actual = pyproj.datadir.get_data_dir()
+    except pyproj.exceptions.DataDirError:
+        proj_actual = ""
+    if not proj_actual.endswith("proj") and PROJ_DIR_CONDA.is_dir():
+        pyproj.datadir.set_data_dir(str(PROJ_DIR_CONDA))
 
 # --- 2. IMPORTACIONES ---
 import geopandas as gpd
 import pandas as pd
+import numpy as np
+import matplotlib
+# En ejecuciones por lotes (sin terminal) no hay ventana: backend Agg sin GUI
+if not sys.stdout.isatty():
+    matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 import contextily as ctx  # <--- AQUÍ la importamos
+import shapely
+from joblib import Memory
+from pyproj import Transformer
 from shapely.geometry import box
 
 # --- 3. CONFIGURACIÓN ---
 BASE_DIR = Path(__file__).resolve().parent.parent
 RIVERS_FILE = BASE_DIR / "data" / "processed" / "red_fluvial_arousa.geojson"
+RIVERS_FGB = RIVERS_FILE.with_suffix(".fgb")  # Misma capa en FlatGeobuf (con índice espacial)
 STATIONS_FILE = BASE_DIR / "data" / "raw" / "aforos_meta_raw.csv"
+CACHE_DIR = BASE_DIR / "data" / "cache"
+BBOX_AROUSA = box(-9.0, 42.45, -8.0, 42.90)  # Lat/Lon, ajustado a Ría de Arousa
+
+# Caché persistente de teselas del mapa base: en ejecuciones posteriores
+# se leen de disco en vez de volver a descargarlas
+CTX_CACHE_DIR = BASE_DIR / ".cache" / "ctx_tiles"
+ctx.set_cache_dir(str(CTX_CACHE_DIR))
+
+# Mapa base ya ensamblado (imagen + extensión) cacheado por caja, zoom y proveedor:
+# con la misma caja no se vuelven a unir ni decodificar teselas
+MEMORIA_MAPA_BASE = Memory(BASE_DIR / ".cache" / "basemap", verbose=0)
+PROVEEDOR_MAPA_BASE = ctx.providers.OpenStreetMap.Mapnik
+ZOOM_MAPA_BASE = 10  # El que elige add_basemap ('auto') para la caja de Arousa
+
+# Columnas de estaciones que usa el mapa (float32 sobra para posicionar en pantalla)
+COLS_ESTACIONES = ['lon', 'lat', 'nomeEstacion']
+DTYPES_ESTACIONES = {'lon': 'float32', 'lat': 'float32', 'nomeEstacion': 'string'}
+
+# Una sola transformación GPS -> Web Mercator (EPSG:3857) para estaciones y ríos
+A_MERCATOR = Transformer.from_crs(4326, 3857, always_xy=True)
+
+def a_mercator(coords):
+    """Reproyecta un array (N, 2) de lon/lat a metros Web Mercator"""
+    x, y = A_MERCATOR.transform(coords[:, 0], coords[:, 1])
+    return np.column_stack((x, y))
+
+# Estilo común de las etiquetas (matplotlib copia el dict en cada texto)
+BBOX_ETIQUETA = dict(facecolor='white', alpha=0.7, edgecolor='none')
+
+@MEMORIA_MAPA_BASE.cache
+def mapa_base(oeste, sur, este, norte, zoom, proveedor):
+    """Imagen del mapa base y su extensión para una caja en Web Mercator"""
+    return ctx.bounds2img(oeste, sur, este, norte, zoom=zoom, source=proveedor, ll=False)
+
+def cargar_rios_web(bbox_geo):
+    """
+    Ríos que tocan la caja, en Web Mercator.
+    No se recortan geométricamente: el mapa se limita a la caja con xlim/ylim.
+    El resultado se guarda en GeoParquet con una clave (caja + mtime/tamaño del GeoJSON):
+    si el archivo de ríos o la caja cambian, se regenera.
+    """
+    st = RIVERS_FILE.stat()
+    clave = hashlib.md5(bbox_geo.wkb + f"{st.st_mtime_ns}:{st.st_size}".encode()).hexdigest()[:12]
+    cache_file = CACHE_DIR / f"rios_caja_web_{clave}.parquet"
+    if cache_file.exists():
+        print(f"⚡ Ríos desde caché: {cache_file.name}")
+        return gpd.read_parquet(cache_file)
+    
+    # El GeoJSON se convierte una sola vez (o cuando cambia) a FlatGeobuf
+    if not RIVERS_FGB.exists() or RIVERS_FGB.stat().st_mtime_ns < st.st_mtime_ns:
+        print(f"🔁 Convirtiendo ríos a FlatGeobuf: {RIVERS_FGB.name}")
+        gpd.read_file(RIVERS_FILE).to_file(RIVERS_FGB, driver='FlatGeobuf')
+    
+    # Lectura por caja: OGR usa el R-tree del archivo y solo lee los tramos
+    # cuya caja envolvente toca la zona (sin parsear el resto ni intersecciones GEOS)
+    gdf_rios_caja = gpd.read_file(RIVERS_FGB, bbox=bbox_geo.bounds)
+    
+    # Convertir geometrías a Metros (Web Mercator) con el mismo Transformer
+    gdf_rios_web = gdf_rios_caja.set_geometry(
+        shapely.transform(gdf_rios_caja.geometry.values, a_mercator), crs="EPSG:3857"
+    )
+    
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    gdf_rios_web.to_parquet(cache_file)
+    return gdf_rios_web
 
 def validar_cobertura():
     print("🗺️  Cargando capas...")
@@ -31,63 +111,80 @@ def validar_cobertura():
     if not RIVERS_FILE.exists():
         print(f"❌ Falta archivo: {RIVERS_FILE}")
         return
-    gdf_rios = gpd.read_file(RIVERS_FILE)
 
     # Cargar Estaciones
-    gdf_estaciones = None
+    df_st = None
     if STATIONS_FILE.exists():
         try:
-            # Leemos con punto y coma
-            df_st = pd.read_csv(STATIONS_FILE, sep=';', encoding='utf-8-sig')
+            # Leemos con punto y coma, solo las columnas que se usan
+            try:
+                df_st = pd.read_csv(STATIONS_FILE, sep=';', encoding='utf-8-sig', engine='pyarrow',
+                                    usecols=COLS_ESTACIONES, dtype=DTYPES_ESTACIONES)
+            except (ImportError, KeyError, ValueError):
+                # Sin pyarrow o sin alguna columna: parser C, que tolera columnas ausentes
+                df_st = pd.read_csv(STATIONS_FILE, sep=';', encoding='utf-8-sig',
+                                    usecols=lambda c: c in COLS_ESTACIONES, dtype=DTYPES_ESTACIONES)
             
             if 'lon' in df_st.columns and 'lat' in df_st.columns:
-                gdf_estaciones = gpd.GeoDataFrame(
-                    df_st, 
-                    geometry=gpd.points_from_xy(df_st.lon, df_st.lat),
-                    crs="EPSG:4326" # Original: GPS (Lat/Lon)
-                )
-                print(f"✅ Estaciones cargadas: {len(gdf_estaciones)}")
+                print(f"✅ Estaciones cargadas: {len(df_st)}")
             else:
                 print("⚠️ CSV sin columnas lat/lon")
+                df_st = None
         except Exception as e:
             print(f"⚠️ Error CSV: {e}")
+            df_st = None
 
     # --- PREPARACIÓN PARA MAPA WEB (MERCATOR) ---
     # Para superponer con Google Maps/OSM, todo debe estar en EPSG:3857
     print("🌍 Reproyectando a Web Mercator...")
     
-    # 1. Definir caja (en Lat/Lon primero) y convertirla
-    bbox_geo = box(-9.0, 42.45, -8.0, 42.90) # Ajustado a Ría de Arousa
-    gdf_rios_clip = gdf_rios.clip(bbox_geo)
+    # 1-2. Filtrar por la caja (en Lat/Lon) y convertir a metros (con caché en disco)
+    gdf_rios_web = cargar_rios_web(BBOX_AROUSA)
     
-    # 2. Convertir geometrías a Metros (Web Mercator)
-    gdf_rios_web = gdf_rios_clip.to_crs(epsg=3857)
+    # Límites del mapa: esquinas de la caja en Web Mercator
+    lon_min, lat_min, lon_max, lat_max = BBOX_AROUSA.bounds
+    lim_x, lim_y = A_MERCATOR.transform([lon_min, lon_max], [lat_min, lat_max])
     
-    if gdf_estaciones is not None:
-        gdf_est_web = gdf_estaciones.to_crs(epsg=3857)
+    if df_st is not None:
         # Filtramos las que caen dentro de la caja visual
-        # (Truco: usaremos los límites de los ríos para el zoom)
+        lon, lat = df_st['lon'].to_numpy(), df_st['lat'].to_numpy()
+        df_st = df_st[(lon >= lon_min) & (lon <= lon_max) & (lat >= lat_min) & (lat <= lat_max)]
+        # Estaciones: arrays de coordenadas directamente, sin geometrías por punto
+        est_x, est_y = A_MERCATOR.transform(df_st['lon'].to_numpy(), df_st['lat'].to_numpy())
 
     # --- PLOTEO ---
     fig, ax = plt.subplots(figsize=(12, 12))
 
     # Capa 1: Ríos
-    gdf_rios_web.plot(ax=ax, color='blue', linewidth=2, alpha=0.6, label='Ríos')
+    # Una sola LineCollection para toda la red (un artista en vez de uno por tramo)
+    partes = shapely.get_parts(gdf_rios_web.geometry.values)  # MultiLineString -> LineString
+    coords, idx = shapely.get_coordinates(partes, return_index=True)
+    tramos = np.split(coords, np.flatnonzero(np.diff(idx)) + 1) if len(coords) else []
+    ax.add_collection(LineCollection(tramos, colors='blue', linewidths=2, alpha=0.6, label='Ríos'))
+    ax.set_aspect('equal')
 
     # Capa 2: Estaciones
-    if gdf_estaciones is not None:
-        gdf_est_web.plot(ax=ax, color='red', markersize=100, edgecolors='white', zorder=5)
+    if df_st is not None:
+        ax.scatter(est_x, est_y, c='red', s=100, edgecolors='white', zorder=5)
         
         # Etiquetas
-        for x, y, label in zip(gdf_est_web.geometry.x, gdf_est_web.geometry.y, gdf_est_web['nomeEstacion']):
-            ax.text(x + 500, y, str(label), fontsize=9, fontweight='bold',
-                    bbox=dict(facecolor='white', alpha=0.7, edgecolor='none'))
+        for x, y, label in zip(est_x + 500, est_y, df_st['nomeEstacion'].astype(str)):
+            ax.text(x, y, label, fontsize=9, fontweight='bold', bbox=BBOX_ETIQUETA)
+
+    # Zoom a la caja: matplotlib recorta lo que sobresale (en lugar de clip())
+    ax.set_xlim(lim_x)
+    ax.set_ylim(lim_y)
 
     # Capa 3: Mapa Base (AQUÍ USAMOS ctx)
     print("🎨 Añadiendo mapa base...")
     try:
-        # ctx.add_basemap descarga los tiles de internet y los pone en el fondo
-        ctx.add_basemap(ax, source=ctx.providers.OpenStreetMap.Mapnik)
+        # Teselas de internet unidas en una imagen (desde caché si la caja ya se pidió)
+        img, extension = mapa_base(lim_x[0], lim_y[0], lim_x[1], lim_y[1],
+                                   ZOOM_MAPA_BASE, PROVEEDOR_MAPA_BASE)
+        ax.imshow(img, extent=extension, interpolation='bilinear', aspect=ax.get_aspect())
+        ax.set_xlim(lim_x)  # imshow reajusta los ejes a la imagen: volvemos a la caja
+        ax.set_ylim(lim_y)
+        ctx.add_attribution(ax, PROVEEDOR_MAPA_BASE.attribution)
     except Exception as e:
         print(f"⚠️ No se pudo cargar el mapa base: {e}")
 
@@ -97,7 +194,9 @@ def validar_cobertura():
     output_img = BASE_DIR / "docs" / "mapa_cobertura_final.png"
     plt.savefig(output_img, dpi=100, bbox_inches='tight')
     print(f"🖼️  Guardado en: {output_img}")
-    plt.show()
+    if sys.stdout.isatty():
+        plt.show()
+    plt.close(fig)
 
 if __name__ == "__main__":
     validar_cobertura()
\ No newline at end of file
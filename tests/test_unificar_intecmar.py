@@ -0,0 +1,76 @@
+# tests/test_unificar_intecmar.py
+# Ejecutar desde la raíz del repo: python -m unittest discover -s tests
+import importlib.util
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+MODULO = REPO_DIR / "src" / "etl" / "01_unificar_intecmar.py"
+FIXTURES = Path(__file__).resolve().parent / "fixtures"
+
+
+def cargar_modulo():
+    """El nombre del script empieza por dígito: se carga desde su ruta"""
+    spec = importlib.util.spec_from_file_location("unificar_intecmar", MODULO)
+    modulo = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(modulo)
+    return modulo
+
+
+class TestCabecerasQCRepetidas(unittest.TestCase):
+    """Los CSV de INTECMAR repiten 'Validación' tras cada variable"""
+
+    @classmethod
+    def setUpClass(cls):
+        # Importar el módulo crea el log y data/interim en el directorio actual
+        cls._cwd = os.getcwd()
+        cls._tmp = tempfile.TemporaryDirectory()
+        os.chdir(cls._tmp.name)
+        cls.m = cargar_modulo()
+
+    @classmethod
+    def tearDownClass(cls):
+        import logging
+        for handler in logging.getLogger().handlers[:]:
+            logging.getLogger().removeHandler(handler)
+            handler.close()
+        os.chdir(cls._cwd)
+        cls._tmp.cleanup()
+
+    def test_mapear_columnas_por_posicion(self):
+        columnas = ['Data', 'Salinidade 1,5 m (PSU)', 'Validación',
+                    'Temperatura 3 m (ºC)', 'Validación', 'Observacións']
+        self.assertEqual(
+            self.m.mapear_columnas(columnas),
+            ['fecha_hora', 'salinidad_1_5m', 'qc_salinidad_1_5m',
+             'temperatura_3m', 'qc_temperatura_3m', None]
+        )
+
+    def test_procesar_archivo_con_validacion_repetida(self):
+        tabla = self.m.procesar_archivo(str(FIXTURES / "cortegada_validacion_repetida.csv"))
+        self.assertIsNotNone(tabla)
+        self.assertEqual(tabla.schema, self.m.ESQUEMA_SALIDA)
+        df = tabla.to_pandas()
+        self.assertEqual(len(df), 3)
+        self.assertEqual(df['estacion'].unique().tolist(), ['cortegada'])
+        np.testing.assert_allclose(df['salinidad_1_5m'], [35.12, 35.10, 35.08], rtol=1e-6)
+        np.testing.assert_allclose(df['temperatura_3m'], [14.2, 14.1, 14.1], rtol=1e-6)
+        # Cada QC corresponde a la variable que tiene justo antes
+        self.assertEqual(df['qc_salinidad_1_5m'].tolist(), [1, 1, 4])
+        self.assertEqual(df['qc_temperatura_3m'].tolist(), [2, 1, 1])
+
+    def test_codigos_qc_fuera_de_rango_quedan_nulos(self):
+        import pandas as pd
+        serie = pd.Series([1.0, 4.0, -999.0, 200.0, 1.5, None])
+        codigos = self.m.a_codigo_qc(serie, "prueba")
+        self.assertEqual(str(codigos.dtype), 'int8[pyarrow]')
+        self.assertEqual(codigos.tolist()[:2], [1, 4])
+        self.assertEqual(codigos.isna().tolist()[2:], [True] * 4)
+
+
+if __name__ == "__main__":
+    unittest.main()